@@ -0,0 +1,348 @@
+"""Benchmark reprodutível do server.py com upstreams locais.
+
+Sobe, no mesmo processo:
+  * um googlevideo falso (intervalos de bytes, m3u8 e segmentos);
+  * uma API Invidious falsa (/api/v1/search e /api/v1/videos/<id>);
+  * um stub de yt_dlp.YoutubeDL.extract_info com latência e taxa de falha configuráveis;
+  * o próprio server.py (werkzeug, threaded) numa porta local.
+
+Em seguida dispara /search, /stream, /play e /proxy em cada nível de
+concorrência e imprime um JSON com vazão, p50/p95/p99 e MB/s do proxy.
+
+Uso:
+    python bench/bench.py --concurrency 1,8,32 --requests 200 --output atual.json
+    python bench/bench.py --compare base.json --output atual.json
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('search', 'stream', 'play', 'proxy')
+# Chamadas ao stub do extract_info neste processo
+extract_calls = {'count': 0}
+
+
+def video_ids(count):
+    return [f"bench{i:06d}"[:11] for i in range(count)]
+
+
+class FakeUpstream:
+    """googlevideo + Invidious falsos num ThreadingHTTPServer"""
+
+    def __init__(self, payload_bytes, segments=6, segment_bytes=64 * 1024):
+        self.payload = bytes(range(256)) * (payload_bytes // 256)
+        self.segments = segments
+        self.segment = b'\x47' * segment_bytes
+        self.requests = 0
+        upstream = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type, extra=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (extra or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                upstream.requests += 1
+                path = urllib.parse.urlsplit(self.path).path
+                if path == '/videoplayback':
+                    return self._media()
+                if path == '/hls/index.m3u8':
+                    lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:4', '#EXT-X-MAP:URI="init.mp4"']
+                    for i in range(upstream.segments):
+                        lines += ['#EXTINF:4,', f'seg{i}.ts']
+                    lines.append('#EXT-X-ENDLIST')
+                    return self._send(200, '\n'.join(lines).encode(), 'application/vnd.apple.mpegurl')
+                if path.startswith('/hls/'):
+                    return self._send(200, upstream.segment, 'video/mp2t')
+                if path == '/api/v1/search':
+                    query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('q', [''])[0]
+                    items = [{'videoId': vid, 'title': f"{query} {vid}", 'lengthSeconds': 200}
+                             for vid in video_ids(10)]
+                    return self._send(200, json.dumps(items).encode(), 'application/json')
+                match = re.fullmatch(r'/api/v1/videos/([\w-]+)', path)
+                if match:
+                    data = {
+                        'title': match.group(1), 'lengthSeconds': 200, 'author': 'bench',
+                        'videoThumbnails': [{'url': ''}],
+                        'adaptiveFormats': [{'type': 'audio/webm', 'bitrate': 160000,
+                                             'url': upstream.media_url(match.group(1))}],
+                    }
+                    return self._send(200, json.dumps(data).encode(), 'application/json')
+                self._send(404, b'not found', 'text/plain')
+
+            def _media(self):
+                size = len(upstream.payload)
+                range_header = self.headers.get('Range')
+                if not range_header:
+                    return self._send(200, upstream.payload, 'audio/webm', {'Accept-Ranges': 'bytes'})
+                start, end = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header).groups()
+                if start == '':
+                    start, end = size - int(end), size - 1
+                else:
+                    start, end = int(start), min(int(end) if end else size - 1, size - 1)
+                if start >= size:
+                    return self._send(416, b'', 'audio/webm', {'Content-Range': f'bytes */{size}'})
+                self._send(206, upstream.payload[start:end + 1], 'audio/webm',
+                           {'Content-Range': f'bytes {start}-{end}/{size}', 'Accept-Ranges': 'bytes'})
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def media_url(self, video_id):
+        return media_url(self.base, len(self.payload), video_id)
+
+
+def media_url(base, size, video_id):
+    expire = int(time.time()) + 6 * 3600
+    return f"{base}/videoplayback?expire={expire}&id={video_id}&itag=251&clen={size}&source=bench"
+
+
+def install_extract_stub(base, size, latency, jitter, failure_rate, seed):
+    """Troca YoutubeDL.extract_info por um stub com latência e falhas configuráveis.
+
+    Também serve de initializer dos processos de extração do servidor.
+    """
+    import yt_dlp
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def extract_info(self, url, download=False, process=True, **kwargs):
+        with lock:
+            extract_calls['count'] += 1
+            delay = max(latency + rng.uniform(-jitter, jitter), 0)
+            fail = rng.random() < failure_rate
+        time.sleep(delay)
+        if fail:
+            raise yt_dlp.utils.DownloadError("Sign in to confirm you're not a bot")
+        if url.startswith('ytsearch'):
+            return {'entries': [{'id': vid, 'title': vid, 'duration': 200, 'url': vid} for vid in video_ids(10)]}
+        if 'list=' in url:
+            entries = ({'id': vid, 'title': vid, 'duration': 200, 'url': vid} for vid in video_ids(200))
+            return {'title': 'bench playlist', 'entries': entries if not process else list(entries)}
+        video_id = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('v', ['bench'])[0]
+        return {'id': video_id, 'title': video_id, 'duration': 200, 'thumbnail': '', 'uploader': 'bench',
+                'url': media_url(base, size, video_id)}
+
+    yt_dlp.YoutubeDL.extract_info = extract_info
+
+
+def start_app(args, upstream):
+    """Importa o server.py configurado para os upstreams falsos e o sobe numa porta local"""
+    os.environ.setdefault('INVIDIOUS_INSTANCES', upstream.base)
+    os.environ['PROXY_CACHE_HOSTS'] = '127.0.0.1'
+    os.environ['PROXY_CACHE_DIR'] = args.cache_dir
+    os.environ['PROXY_CACHE_MAX_BYTES'] = str(args.disk_cache_mb * 1024 * 1024)
+    os.environ['METADATA_DB_PATH'] = os.path.join(args.cache_dir, 'meta.sqlite3')
+    os.environ['EXTRACT_PROCESSES'] = str(args.extract_processes)
+    # Todo o tráfego vem de um único cliente; o token bucket distorceria as medidas
+    os.environ.setdefault('RATE_LIMIT_RPS', '0')
+    if args.async_proxy:
+        os.environ['ASYNC_PROXY_PORT'] = str(args.async_proxy)
+    sys.path.insert(0, ROOT)
+    import_start = time.perf_counter()
+    import server
+    startup = {'importS': round(time.perf_counter() - import_start, 4)}
+    from werkzeug.serving import make_server
+    install_extract_stub(upstream.base, len(upstream.payload), *args.stub_args)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    # Os processos de extração recebem o mesmo stub do extract_info
+    server.extraction_pool = server.ExtractionProcessPool(
+        args.extract_processes, server.EXTRACT_TIMEOUT, initializer=install_extract_stub,
+        initargs=(upstream.base, len(upstream.payload)) + args.stub_args)
+
+    server.async_proxy.start('127.0.0.1')
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_port}"
+    startup['bindS'] = round(time.perf_counter() - import_start, 4)
+    server.warmup.start()
+    while requests.get(f"{base}/ready", timeout=5).status_code != 200:
+        time.sleep(0.02)
+    startup['readyS'] = round(time.perf_counter() - import_start, 4)
+    return server, base, startup
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_scenario(name, base, upstream, concurrency, total, id_pool):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    ids = video_ids(id_pool)
+    proxy_target = urllib.parse.quote_plus(upstream.media_url('bench000000'))
+
+    def one(i):
+        video_id = ids[i % len(ids)]
+        if name == 'search':
+            url = f"{base}/search?q=bench+query+{i % id_pool}"
+        elif name == 'stream':
+            url = f"{base}/stream/{video_id}"
+        elif name == 'play':
+            url = f"{base}/play?q=bench+play+{i % id_pool}"
+        else:
+            url = f"{base}/proxy?url={proxy_target}&vid=bench000000"
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=120)
+            size = len(response.content)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            size, ok = 0, False
+        return time.perf_counter() - start, size, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(s[0] * 1000 for s in samples)
+    total_bytes = sum(s[1] for s in samples)
+    result = {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': sum(1 for s in samples if not s[2]),
+        'durationS': round(elapsed, 4),
+        'throughputRps': round(total / elapsed, 2),
+        'p50Ms': round(percentile(latencies, 50), 2),
+        'p95Ms': round(percentile(latencies, 95), 2),
+        'p99Ms': round(percentile(latencies, 99), 2),
+        'meanMs': round(statistics.fmean(latencies), 2),
+    }
+    if name == 'proxy':
+        result['proxyMBps'] = round(total_bytes / elapsed / (1024 * 1024), 2)
+    return result
+
+
+def reset_caches(server, round_id):
+    """Zera os caches em memória e o armazém persistente para cada rodada começar fria"""
+    server.stream_cache = server.TTLCache(server.STREAM_CACHE_MAX_ENTRIES, server.STREAM_CACHE_DEFAULT_TTL)
+    server.search_cache = server.TTLCache(server.SEARCH_CACHE_MAX_ENTRIES, server.SEARCH_CACHE_TTL)
+    path = os.path.join(os.path.dirname(server.METADATA_DB_PATH), f"meta-{round_id}.sqlite3")
+    server.metadata_store = server.MetadataStore(path, server.METADATA_TTL)
+
+
+def compare(baseline, current):
+    """Diferença percentual por (cenário, concorrência) entre duas execuções"""
+    base = {(r['scenario'], r['concurrency']): r for r in baseline['results']}
+    rows = []
+    for result in current['results']:
+        before = base.get((result['scenario'], result['concurrency']))
+        if not before:
+            continue
+        row = {'scenario': result['scenario'], 'concurrency': result['concurrency']}
+        for key in ('throughputRps', 'p50Ms', 'p95Ms', 'p99Ms', 'proxyMBps'):
+            if before.get(key) and result.get(key) is not None:
+                row[key + 'DeltaPct'] = round((result[key] - before[key]) / before[key] * 100, 2)
+        rows.append(row)
+    return rows
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32', help='níveis de concorrência separados por vírgula')
+    parser.add_argument('--requests', type=int, default=200, help='requisições por cenário e nível')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--id-pool', type=int, default=50, help='vídeos/buscas distintos (controla a taxa de cache)')
+    parser.add_argument('--cold', action='store_true', help='zera os caches em memória antes de cada rodada')
+    parser.add_argument('--latency-ms', type=float, default=300, help='latência média do extract_info falso')
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fração de extract_info que falham')
+    parser.add_argument('--payload-mb', type=float, default=4, help='tamanho da mídia servida pelo googlevideo falso')
+    parser.add_argument('--disk-cache-mb', type=int, default=0, help='cache em disco do /proxy (0 desativa)')
+    parser.add_argument('--async-proxy', type=int, default=0, help='porta do motor assíncrono (0 desativa)')
+    parser.add_argument('--extract-processes', type=int, default=0,
+                        help='processos de extração do servidor (0 extrai nas threads)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--verbose', action='store_true', help='mantém os logs INFO do servidor')
+    parser.add_argument('--output', help='grava o JSON neste arquivo além de imprimir')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    args.cache_dir = tempfile.mkdtemp(prefix='ytproxy-bench-')
+    upstream = FakeUpstream(int(args.payload_mb * 1024 * 1024))
+    args.stub_args = (args.latency_ms / 1000, args.jitter_ms / 1000, args.failure_rate, args.seed)
+    server, base, startup = start_app(args, upstream)
+
+    results = []
+    try:
+        for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+            for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                if args.cold:
+                    reset_caches(server, len(results))
+                result = run_scenario(name, base, upstream, concurrency, args.requests, args.id_pool)
+                results.append(result)
+                print(f"{name:>7} c={concurrency:<4} {result['throughputRps']:>9} req/s  "
+                      f"p50={result['p50Ms']}ms p99={result['p99Ms']}ms", file=sys.stderr)
+    finally:
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'startup': startup,
+            'extractCalls': extract_calls['count'] + server.extraction_pool.calls,
+            'upstreamRequests': upstream.requests,
+            'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'cache_dir', 'verbose', 'stub_args')},
+        },
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as fh:
+            report['comparison'] = compare(json.load(fh), report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
-from flask import Flask, jsonify, request, send_file, Response, stream_with_context
-import yt_dlp as youtube_dl
+from flask import Flask, jsonify, request, send_file, Response, stream_with_context, g
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
 import random
 import time
@@ -9,21 +9,1516 @@ import re
 import logging
 import asyncio
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import os
+import json
+import sys
+import uuid
+import queue
+import atexit
+import contextvars
+import logging.handlers
+import importlib
+import importlib.util
+import mmap
+import hashlib
+import functools
+import itertools
+import tempfile
+import sqlite3
+import shutil
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+import socket
+import signal
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+
+class LazyModule:
+    """Módulo importado só no primeiro acesso a um atributo, uma vez entre threads"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def available(self):
+        return self._module is not None or importlib.util.find_spec(self._name.split('.')[0]) is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+# Dependências pesadas ficam para o primeiro uso: o yt-dlp carrega centenas de
+# extratores e o aiohttp (opcional) só é usado pelo motor assíncrono do /proxy
+youtube_dl = LazyModule('yt_dlp')
+aiohttp = LazyModule('aiohttp')
+web = LazyModule('aiohttp.web')
+
+# Trace da requisição atual (propagado para as threads do resolver via copy_context)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# Formato dos logs: 'text' (padrão) ou 'json', uma linha por registro
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+
+
+class TraceIdFilter(logging.Filter):
+    """Anota cada registro com o trace da requisição (roda na thread que loga)"""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        record.trace_id = trace.id if trace is not None else '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Registro em JSON; campos extras vão em extra={'fields': {...}}"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'traceId': getattr(record, 'trace_id', '-'),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(use_queue=True):
+    """Logs saem por uma fila: as threads das requisições só enfileiram e uma
+    thread do QueueListener formata e escreve no stderr.
+
+    Sem fila (supervisor do modo prefork, que não pode ter threads ao fazer
+    fork), o handler escreve direto.
+    """
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s'))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    if not use_queue:
+        handler.addFilter(TraceIdFilter())
+        root.handlers[:] = [handler]
+        return None
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TraceIdFilter())
+    root.handlers[:] = [queue_handler]
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
+# Referência para o tempo de subida reportado pelo /ready
+PROCESS_STARTED = time.monotonic()
 
 app = Flask(__name__)
 
+# Limite de entradas do cache de streams resolvidos (LRU)
+STREAM_CACHE_MAX_ENTRIES = int(os.environ.get('STREAM_CACHE_MAX_ENTRIES', '512'))
+# TTL usado quando a URL não traz o parâmetro expire=
+STREAM_CACHE_DEFAULT_TTL = float(os.environ.get('STREAM_CACHE_DEFAULT_TTL', '300'))
+# Margem de segurança antes do expire= para não entregar URL prestes a expirar
+STREAM_CACHE_EXPIRY_MARGIN = float(os.environ.get('STREAM_CACHE_EXPIRY_MARGIN', '120'))
+# Resolução escalonada: atraso antes de lançar a próxima estratégia, prazo total e threads
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', '3'))
+RESOLVE_TIMEOUT = float(os.environ.get('RESOLVE_TIMEOUT', '45'))
+RESOLVER_WORKERS = int(os.environ.get('RESOLVER_WORKERS', '16'))
+# Instâncias Invidious (separadas por vírgula), circuit breaker e sondas em segundo plano
+INVIDIOUS_INSTANCES = [i.strip().rstrip('/') for i in os.environ.get(
+    'INVIDIOUS_INSTANCES',
+    'https://inv.riverside.rocks,https://invidious.snopyta.org,https://yewtu.be,https://invidious.kanicloud.com'
+).split(',') if i.strip()]
+INVIDIOUS_FAILURE_THRESHOLD = int(os.environ.get('INVIDIOUS_FAILURE_THRESHOLD', '3'))
+INVIDIOUS_COOLDOWN = float(os.environ.get('INVIDIOUS_COOLDOWN', '30'))
+INVIDIOUS_MAX_COOLDOWN = float(os.environ.get('INVIDIOUS_MAX_COOLDOWN', '600'))
+INVIDIOUS_PROBE_INTERVAL = float(os.environ.get('INVIDIOUS_PROBE_INTERVAL', '0'))
+# Resolução em lote: threads compartilhadas e máximo de IDs por requisição
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '8'))
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', '100'))
+# Playlists: tamanho padrão/máximo de página e cursores guardados
+PLAYLIST_PAGE_SIZE = int(os.environ.get('PLAYLIST_PAGE_SIZE', '50'))
+PLAYLIST_MAX_LIMIT = int(os.environ.get('PLAYLIST_MAX_LIMIT', '5000'))
+PLAYLIST_CURSOR_MAX_ENTRIES = int(os.environ.get('PLAYLIST_CURSOR_MAX_ENTRIES', '64'))
+# Pré-busca de faixas seguintes (0 desativa): quantas, threads e orçamento de tarefas pendentes
+PREFETCH_COUNT = int(os.environ.get('PREFETCH_COUNT', '0'))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', '2'))
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', '8'))
+# Cache de buscas: limite de entradas e TTLs para texto e playlists
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '1024'))
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '600'))
+PLAYLIST_CACHE_TTL = float(os.environ.get('PLAYLIST_CACHE_TTL', '1800'))
+# Pool de instâncias YoutubeDL: tamanho por perfil e usos antes da reciclagem
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', '4'))
+YDL_POOL_MAX_USES = int(os.environ.get('YDL_POOL_MAX_USES', '50'))
+# Processos dedicados ao extract_info (0 mantém a extração nas threads) e prazo por chamada
+EXTRACT_PROCESSES = int(os.environ.get('EXTRACT_PROCESSES', '2'))
+EXTRACT_TIMEOUT = float(os.environ.get('EXTRACT_TIMEOUT', '20'))
+# Admissão: extrações simultâneas, fila de espera por vaga e tempo máximo na fila.
+# Com o pool de processos ativo o padrão é um por processo: vagas além disso só
+# esperariam dentro do pool, segurando a vaga até estourar o EXTRACT_TIMEOUT.
+EXTRACT_CONCURRENCY = int(os.environ.get('EXTRACT_CONCURRENCY', str(EXTRACT_PROCESSES if EXTRACT_PROCESSES > 0 else 8)))
+EXTRACT_QUEUE_SIZE = int(os.environ.get('EXTRACT_QUEUE_SIZE', '32'))
+EXTRACT_QUEUE_TIMEOUT = float(os.environ.get('EXTRACT_QUEUE_TIMEOUT', '10'))
+# Token bucket por cliente nos endpoints que extraem (0 desativa)
+RATE_LIMIT_RPS = float(os.environ.get('RATE_LIMIT_RPS', '5'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '10000'))
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', '').lower() in ('1', 'true', 'yes')
+# Cliente HTTP upstream: hosts com pool próprio, conexões por host e timeouts
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '32'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '64'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '15'))
+# Tamanho máximo de cada busca de intervalo no upstream (googlevideo limita requisições grandes)
+PROXY_RANGE_CHUNK = int(os.environ.get('PROXY_RANGE_CHUNK', str(4 * 1024 * 1024)))
+# Cache em disco dos bytes servidos pelo /proxy (0 desativa)
+PROXY_CACHE_DIR = os.environ.get('PROXY_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'yt-proxy-cache'))
+PROXY_CACHE_MAX_BYTES = int(os.environ.get('PROXY_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+# Sufixos de host cujas respostas podem ser guardadas no cache em disco
+PROXY_CACHE_HOSTS = tuple(h.strip() for h in os.environ.get('PROXY_CACHE_HOSTS', 'googlevideo.com').split(',') if h.strip())
+# Banco SQLite persistente de metadados, buscas e streams resolvidos (vazio desativa)
+METADATA_DB_PATH = os.environ.get('METADATA_DB_PATH', os.path.join(tempfile.gettempdir(), 'yt-proxy-meta.sqlite3'))
+METADATA_TTL = float(os.environ.get('METADATA_TTL', str(7 * 24 * 3600)))
+# /transcode: binário do ffmpeg, processos simultâneos e cache em disco das saídas completas
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+TRANSCODE_MAX_PROCS = int(os.environ.get('TRANSCODE_MAX_PROCS', '2'))
+TRANSCODE_CACHE_DIR = os.environ.get('TRANSCODE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'yt-proxy-transcode'))
+TRANSCODE_CACHE_MAX_BYTES = int(os.environ.get('TRANSCODE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Perfilador por amostragem: requisições acima de PROFILE_SLOW_MS (0 desativa), uma a cada
+# PROFILE_EVERY, amostradas a cada PROFILE_INTERVAL_MS; dumps em PROFILE_DIR (vazio só loga)
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_EVERY = int(os.environ.get('PROFILE_EVERY', '1'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '10'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+# Modo produção: processos workers no mesmo socket (1 mantém o servidor de um processo só),
+# endereço de escuta e entradas do cache compartilhado entre eles. Os limites de
+# RATE_LIMIT_*, EXTRACT_CONCURRENCY/EXTRACT_QUEUE_SIZE e TRANSCODE_MAX_PROCS valem por
+# worker (o total é multiplicado por WORKERS); os orçamentos PROXY_CACHE_MAX_BYTES e
+# TRANSCODE_CACHE_MAX_BYTES são divididos entre eles, cada um no seu subdiretório.
+WORKERS = int(os.environ.get('WORKERS', '1'))
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', '3000'))
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', '20000'))
+# Motor assíncrono do /proxy: porta (0 desativa), URL pública e buffer por conexão
+ASYNC_PROXY_PORT = int(os.environ.get('ASYNC_PROXY_PORT', '0'))
+ASYNC_PROXY_PUBLIC_URL = os.environ.get('ASYNC_PROXY_PUBLIC_URL', '').rstrip('/')
+ASYNC_PROXY_BUFFER = int(os.environ.get('ASYNC_PROXY_BUFFER', str(256 * 1024)))
+ASYNC_PROXY_CHUNK = int(os.environ.get('ASYNC_PROXY_CHUNK', str(64 * 1024)))
+# Manifestos m3u8 reescritos: TTL para live e VOD, e segmentos lidos adiante (0 desativa)
+MANIFEST_CACHE_MAX_ENTRIES = int(os.environ.get('MANIFEST_CACHE_MAX_ENTRIES', '256'))
+MANIFEST_LIVE_TTL = float(os.environ.get('MANIFEST_LIVE_TTL', '2'))
+MANIFEST_VOD_TTL = float(os.environ.get('MANIFEST_VOD_TTL', '300'))
+SEGMENT_READAHEAD = int(os.environ.get('SEGMENT_READAHEAD', '0'))
+SEGMENT_READAHEAD_WORKERS = int(os.environ.get('SEGMENT_READAHEAD_WORKERS', '4'))
+
+
+class TTLCache:
+    """Cache LRU em memória com TTL por entrada, seguro entre threads."""
+
+    def __init__(self, max_entries, default_ttl):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_entry(self, key):
+        """Como get, mas devolve (valor, segundos restantes), ou (None, 0)"""
+        value = self.get(key)
+        if value is None:
+            return None, 0
+        with self._lock:
+            item = self._data.get(key)
+        return (value, item[1] - time.monotonic()) if item else (None, 0)
+
+    def contains(self, key):
+        """Verifica a presença de uma entrada válida sem afetar LRU nem estatísticas"""
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] > time.monotonic()
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a entrada, se existir"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'maxEntries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def url_expiry_ttl(media_url, default_ttl=STREAM_CACHE_DEFAULT_TTL, margin=STREAM_CACHE_EXPIRY_MARGIN):
+    """Calcula o TTL a partir do parâmetro expire= das URLs do googlevideo."""
+    try:
+        expire = urllib.parse.parse_qs(urllib.parse.urlsplit(media_url).query).get('expire')
+        if not expire:
+            return default_ttl
+        return float(expire[0]) - time.time() - margin
+    except (TypeError, ValueError):
+        return default_ttl
+
+
+# Cache de streams resolvidos por video_id (URL original, sem o proxy)
+stream_cache = TTLCache(STREAM_CACHE_MAX_ENTRIES, STREAM_CACHE_DEFAULT_TTL)
+
+
+class SingleFlight:
+    """Agrupa chamadas concorrentes com a mesma chave em uma única execução.
+
+    A primeira thread (líder) executa a função; as demais aguardam e recebem
+    o mesmo resultado, ou a mesma exceção.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.followers = 0
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.executions += 1
+            else:
+                call.followers += 1
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'inFlight': len(self._calls),
+                'executions': self.executions,
+                'shared': self.shared,
+            }
+
+
+# Cache de resultados de busca por chave normalizada (ver search_key)
+search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL)
+
+# Extrações em andamento compartilhadas entre requisições simultâneas
+extraction_flight = SingleFlight()
+
+
+class Metrics:
+    """Registro de métricas no formato de texto do Prometheus.
+
+    Os valores ficam em shards com locks próprios, escolhidos pela thread,
+    para que threads diferentes quase nunca disputem o mesmo lock no
+    caminho quente. Os shards só são somados na coleta (/metrics).
+    """
+
+    SHARDS = 16
+    # Índice de shard por thread, atribuído em rodízio na primeira métrica que ela
+    # atualiza (get_ident() são endereços alinhados e cairiam todos no mesmo shard)
+    _thread_shard = threading.local()
+    _next_shard = itertools.count()
+
+    @classmethod
+    def shard_index(cls):
+        index = getattr(cls._thread_shard, 'index', None)
+        if index is None:
+            index = cls._thread_shard.index = next(cls._next_shard) % cls.SHARDS
+        return index
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(_Metric(name, help_text, 'counter', labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(_Metric(name, help_text, 'gauge', labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=None):
+        return self._register(_Histogram(name, help_text, labels, buckets or LATENCY_BUCKETS))
+
+    def collector(self, fn):
+        """Registra fn() -> [(nome, tipo, help, [(labels, valor), ...])] lida na coleta"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        out = []
+        for metric in self._metrics:
+            out.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                for name, kind, help_text, samples in fn():
+                    out.append(f"# HELP {name} {help_text}")
+                    out.append(f"# TYPE {name} {kind}")
+                    for labels, value in samples:
+                        out.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            except Exception as e:
+                logger.error(f"Erro no coletor de métricas {fn.__name__}: {e}")
+        return '\n'.join(out) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Contador ou gauge com shards; o valor é a soma dos shards"""
+
+    def __init__(self, name, help_text, kind, labels):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labels = tuple(labels)
+        self._shards = [({}, threading.Lock()) for _ in range(Metrics.SHARDS)]
+
+    def _shard(self):
+        return self._shards[Metrics.shard_index()]
+
+    def inc(self, *label_values, value=1):
+        data, lock = self._shard()
+        with lock:
+            data[label_values] = data.get(label_values, 0) + value
+
+    def dec(self, *label_values, value=1):
+        self.inc(*label_values, value=-value)
+
+    def _totals(self):
+        totals = {}
+        for data, lock in self._shards:
+            with lock:
+                items = list(data.items())
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._totals().items()):
+            lines.append(f"{self.name}{_format_labels(zip(self.labels, key))} {_format_value(value)}")
+        return lines
+
+
+class _Histogram(_Metric):
+    def __init__(self, name, help_text, labels, buckets):
+        super().__init__(name, help_text, 'histogram', labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        data, lock = self._shard()
+        with lock:
+            series = data.get(label_values)
+            if series is None:
+                # contagens por bucket, depois soma e total
+                series = data[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def render(self):
+        totals = {}
+        for data, lock in self._shards:
+            with lock:
+                items = [(key, list(series)) for key, series in data.items()]
+            for key, series in items:
+                acc = totals.setdefault(key, [0] * len(series))
+                for i, value in enumerate(series):
+                    acc[i] += value
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(totals.items()):
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STREAM_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+metrics = Metrics()
+EXTRACT_SECONDS = metrics.histogram(
+    'ytproxy_extract_seconds', 'Duração da resolução de áudio por estratégia', ('strategy', 'outcome'))
+SEARCH_SECONDS = metrics.histogram(
+    'ytproxy_search_seconds', 'Duração do fast_search por tipo de busca', ('type', 'cache'))
+PROXY_TTFB_SECONDS = metrics.histogram(
+    'ytproxy_proxy_ttfb_seconds', 'Tempo até o primeiro byte no /proxy', ('engine',))
+PROXY_DURATION_SECONDS = metrics.histogram(
+    'ytproxy_proxy_duration_seconds', 'Duração total das respostas do /proxy', ('engine',),
+    buckets=STREAM_DURATION_BUCKETS)
+PROXY_BYTES = metrics.counter('ytproxy_proxy_bytes_total', 'Bytes enviados pelo /proxy', ('engine',))
+PROXY_ACTIVE = metrics.gauge('ytproxy_proxy_active_streams', 'Respostas do /proxy em andamento', ('engine',))
+BOT_RETRIES = metrics.counter('ytproxy_bot_detection_retries_total', 'Retentativas por detecção de bot no safe_extract_info')
+EXTRACT_QUEUE_WAIT_SECONDS = metrics.histogram(
+    'ytproxy_extract_queue_wait_seconds', 'Espera por uma vaga de extração', ('outcome',))
+ADMISSION_REJECTED = metrics.counter(
+    'ytproxy_admission_rejected_total', 'Requisições recusadas pelo controle de admissão', ('reason',))
+
+
+class Trace:
+    """Etapas de uma requisição, somadas por nome, para o header Server-Timing"""
+
+    ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id if trace_id and self.ID_PATTERN.match(trace_id) else uuid.uuid4().hex[:16]
+        self.started = time.monotonic()
+        self.stages = {}
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def server_timing(self):
+        with self._lock:
+            stages = list(self.stages.items())
+        parts = []
+        for name, (total, count) in stages:
+            part = f"{name};dur={total * 1000:.1f}"
+            if count > 1:
+                part += f';desc="x{count}"'
+            parts.append(part)
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ', '.join(parts)
+
+    def summary(self):
+        with self._lock:
+            return {name: round(total * 1000, 1) for name, (total, _) in self.stages.items()}
+
+
+def trace_add(name, seconds):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Mede um trecho como etapa do trace atual (sem trace, não faz nada)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, time.monotonic() - start)
+
+
+def traced(name):
+    """Decorador: a função inteira vira uma etapa do trace"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SlowRequestProfiler:
+    """Perfilador por amostragem para requisições lentas.
+
+    Uma a cada `every` requisições é acompanhada: enquanto ela passa do
+    limiar, uma thread amostra a cada `interval` a pilha das threads que
+    trabalham para ela (a da requisição e as do resolver) via
+    sys._current_frames(). No fim, as pilhas agregadas (formato "collapsed",
+    uma pilha por linha com contagem) vão para PROFILE_DIR ou para o log.
+    """
+
+    def __init__(self, slow_ms, every, interval_ms, directory):
+        self.slow = slow_ms / 1000
+        self.every = max(every, 1)
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self._watched = {}
+        self._lock = threading.Lock()
+        # Acorda a thread de amostragem quando algo passa a ser acompanhado
+        self._changed = threading.Condition(self._lock)
+        self._thread = None
+        self._count = 0
+        self.dumps = 0
+
+    @property
+    def enabled(self):
+        return self.slow > 0
+
+    def should_sample(self):
+        if not self.enabled:
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self.every == 0
+
+    def register(self, trace):
+        """Passa a amostrar a thread atual para o trace"""
+        with self._lock:
+            self._watched[threading.get_ident()] = trace
+            self._changed.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+                self._thread.start()
+
+    def unregister(self):
+        with self._lock:
+            self._watched.pop(threading.get_ident(), None)
+
+    @contextmanager
+    def watch(self, trace):
+        """Amostra a thread atual enquanto trabalha para um trace acompanhado"""
+        if trace is None or trace.profile is None:
+            yield
+            return
+        self.register(trace)
+        try:
+            yield
+        finally:
+            self.unregister()
+
+    def _sample_loop(self):
+        while True:
+            with self._changed:
+                # Parada enquanto nada é acompanhado; senão dorme até o primeiro
+                # trace passar do limiar ou, já acima dele, pelo intervalo
+                while not self._watched:
+                    self._changed.wait()
+                delay = max(min(self.slow - trace.elapsed() for trace in self._watched.values()), self.interval)
+                self._changed.wait(delay)
+                watched = [(ident, trace) for ident, trace in self._watched.items() if trace.elapsed() >= self.slow]
+            if not watched:
+                continue
+            frames = sys._current_frames()
+            for ident, trace in watched:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                with trace._lock:
+                    trace.profile[key] = trace.profile.get(key, 0) + 1
+
+    def dump(self, trace, path):
+        """Grava as amostras de um trace que passou do limiar"""
+        if not trace.profile:
+            return
+        lines = [f"{stack} {count}" for stack, count in sorted(trace.profile.items(), key=lambda item: -item[1])]
+        self.dumps += 1
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            target = os.path.join(self.directory, f"{int(time.time())}-{trace.id}.collapsed")
+            with open(target, 'w') as fh:
+                fh.write('\n'.join(lines) + '\n')
+            logger.warning(f"Requisição lenta {path} ({trace.elapsed():.2f}s): {sum(trace.profile.values())} amostras em {target}")
+        else:
+            logger.warning(f"Requisição lenta {path} ({trace.elapsed():.2f}s), pilhas mais frequentes:\n" + '\n'.join(lines[:10]))
+
+
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_EVERY, PROFILE_INTERVAL_MS, PROFILE_DIR)
+
+
+class StreamMeter:
+    """Mede uma resposta do /proxy: TTFB, duração, bytes e streams ativos"""
+
+    # Bytes acumulados localmente antes de atualizar o contador compartilhado
+    FLUSH_BYTES = 1024 * 1024
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.start = time.monotonic()
+        self._first = False
+        self._pending = 0
+        self._closed = False
+        PROXY_ACTIVE.inc(engine)
+
+    def add(self, size):
+        if not self._first:
+            self._first = True
+            PROXY_TTFB_SECONDS.observe(time.monotonic() - self.start, self.engine)
+        self._pending += size
+        if self._pending >= self.FLUSH_BYTES:
+            PROXY_BYTES.inc(self.engine, value=self._pending)
+            self._pending = 0
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._pending:
+            PROXY_BYTES.inc(self.engine, value=self._pending)
+        PROXY_DURATION_SECONDS.observe(time.monotonic() - self.start, self.engine)
+        PROXY_ACTIVE.dec(self.engine)
+
+    def _wrap(self, body):
+        for chunk in body:
+            self.add(len(chunk))
+            yield chunk
+
+    def attach(self, resp):
+        """Instrumenta uma resposta do Flask; send_file passa direto para manter o sendfile"""
+        if resp.direct_passthrough:
+            self.add(resp.content_length or 0)
+        else:
+            resp.response = self._wrap(resp.response)
+        resp.call_on_close(self.close)
+        return resp
+
+
+def metered(engine):
+    """Decorador de rota que mede a resposta com StreamMeter"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            meter = StreamMeter(engine)
+            try:
+                rv = fn(*args, **kwargs)
+            except Exception:
+                meter.close()
+                raise
+            return meter.attach(app.make_response(rv))
+        return wrapper
+    return decorator
+
+
+class UpstreamHTTP:
+    """Sessão HTTP compartilhada com pools de conexão keep-alive por host.
+
+    O urllib3 mantém um pool por host (até pool_hosts hosts) com até
+    pool_maxsize conexões cada; a sessão é compartilhada entre as threads.
+    """
+
+    def __init__(self, pool_hosts=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        """Conexões abertas vs. reutilizadas por host (pools ativos)"""
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened = pool.num_connections
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'opened': opened,
+                'requests': pool.num_requests,
+                'reused': max(pool.num_requests - opened, 0),
+            }
+        return {
+            'opened': sum(h['opened'] for h in hosts.values()),
+            'reused': sum(h['reused'] for h in hosts.values()),
+            'hosts': hosts,
+        }
+
+
+# Cliente HTTP para /proxy e APIs Invidious
+upstream = UpstreamHTTP()
+
+
+class DiskRangeCache:
+    """Cache em disco, limitado em bytes, de recursos preenchidos por intervalos.
+
+    Cada entrada é um arquivo esparso do tamanho total do recurso (<key>.bin)
+    mais um índice JSON (<key>.idx) com os intervalos [start, end) já gravados.
+    A remoção é LRU pelo último acesso quando os bytes gravados passam do limite.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def partition(self, index, count):
+        """Modo prefork: usa o subdiretório worker-<index> com 1/count do orçamento.
+
+        Cada worker tem seu próprio índice em memória; dividir o diretório evita
+        que um remova arquivos que outro ainda considera em cache.
+        """
+        self.directory = os.path.join(self.directory, f"worker-{index}")
+        self.max_bytes //= max(count, 1)
+        self._entries = OrderedDict()
+        self.bytes_used = 0
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def _load(self):
+        """Recarrega os índices gravados por execuções anteriores"""
+        indexes = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.idx'):
+                continue
+            key = name[:-4]
+            try:
+                with open(self._path(key, 'idx')) as fh:
+                    entry = json.load(fh)
+                if not os.path.exists(self._path(key, 'bin')):
+                    raise ValueError('missing data file')
+                indexes.append((os.path.getmtime(self._path(key, 'idx')), key, entry))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Descartando entrada de cache {key}: {e}")
+                self._remove_files(key)
+        for _, key, entry in sorted(indexes):
+            self._entries[key] = entry
+            self.bytes_used += sum(end - start for start, end in entry['ranges'])
+        self._evict()
+
+    def _remove_files(self, key):
+        for ext in ('bin', 'idx'):
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def _save_index(self, key, entry):
+        tmp = self._path(key, 'idx.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump(entry, fh)
+        os.replace(tmp, self._path(key, 'idx'))
+
+    def _evict(self):
+        while self.bytes_used > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self.bytes_used -= sum(end - start for start, end in entry['ranges'])
+            self.evictions += 1
+            self._remove_files(key)
+
+    def lookup(self, key, start, end):
+        """Retorna a entrada se [start, end] (inclusivo) estiver todo em disco"""
+        with self._lock:
+            entry = self._entries.get(key)
+            covered = entry is not None and any(
+                r_start <= start and end < r_end for r_start, r_end in entry['ranges'])
+            if not covered:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry, path=self._path(key, 'bin'))
+
+    def size(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['size'] if entry else None
+
+    def is_complete(self, key):
+        """Entrada inteira em disco (sem afetar LRU nem estatísticas)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry['ranges'] == [[0, entry['size']]]
+
+    def open_fill(self, key, size, content_type):
+        return CacheFill(self, key, size, content_type)
+
+    def _ensure(self, key, size, content_type):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['size'] == size:
+                return True
+            if entry is not None:
+                self.bytes_used -= sum(end - start for start, end in entry['ranges'])
+                del self._entries[key]
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = {'size': size, 'contentType': content_type, 'ranges': []}
+        with open(self._path(key, 'bin'), 'ab') as fh:
+            fh.truncate(size)
+        return True
+
+    def _add_range(self, key, start, end):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            merged = []
+            for r_start, r_end in sorted(entry['ranges'] + [[start, end]]):
+                if merged and r_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], r_end)
+                else:
+                    merged.append([r_start, r_end])
+            before = sum(e - b for b, e in entry['ranges'])
+            entry['ranges'] = merged
+            added = sum(e - b for b, e in merged) - before
+            self.bytes_used += added
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _commit(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry = dict(entry, ranges=[list(r) for r in entry['ranges']])
+        try:
+            self._save_index(key, entry)
+        except OSError as e:
+            logger.warning(f"Falha ao gravar índice do cache {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytesUsed': self.bytes_used,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class CacheFill:
+    """Grava no cache em disco os bytes que passam pelo proxy, por offset"""
+
+    def __init__(self, cache, key, size, content_type):
+        self.cache = cache
+        self.key = key
+        self._fd = None
+        self._start = self._pos = None
+        try:
+            if cache.enabled and key and size and cache._ensure(key, size, content_type):
+                self._fd = os.open(cache._path(key, 'bin'), os.O_WRONLY)
+        except OSError as e:
+            logger.warning(f"Cache em disco indisponível para {key}: {e}")
+
+    def write(self, offset, data):
+        if self._fd is None:
+            return
+        if self._pos != offset:
+            self._flush_range()
+            self._start = self._pos = offset
+        try:
+            os.pwrite(self._fd, data, offset)
+            self._pos += len(data)
+        except OSError as e:
+            logger.warning(f"Falha ao gravar cache {self.key}: {e}")
+            self.close()
+
+    def _flush_range(self):
+        if self._start is not None and self._pos > self._start:
+            self.cache._add_range(self.key, self._start, self._pos)
+        self._start = self._pos = None
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._flush_range()
+        os.close(self._fd)
+        self._fd = None
+        self.cache._commit(self.key)
+
+
+# Cache em disco do /proxy, chaveado por vídeo + itag (ver proxy_cache_key)
+proxy_cache = DiskRangeCache(PROXY_CACHE_DIR, PROXY_CACHE_MAX_BYTES)
+
+
+class MetadataStore:
+    """Armazém SQLite (WAL) de metadados de vídeo, buscas e streams resolvidos.
+
+    Sobrevive a reinícios e pode ser compartilhado por vários processos: cada
+    thread abre sua própria conexão na primeira consulta (e de novo após um
+    fork), o WAL deixa leitores concorrerem com o escritor e o busy_timeout
+    absorve a disputa entre escritores. Cada tabela guarda JSON com expiração
+    absoluta; entradas vencidas são ignoradas na leitura e limpas aos poucos.
+    """
+
+    TABLES = ('videos', 'searches', 'streams')
+
+    def __init__(self, path, default_ttl):
+        self.path = path
+        self.default_ttl = default_ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ready = False
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        """Conexão da thread atual, aberta (e o esquema criado) sob demanda"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            if not self._ready:
+                for table in self.TABLES:
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                                 "(key TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+                self._ready = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @traced('l2')
+    def get(self, table, key):
+        """Valor ainda válido e segundos restantes, ou (None, 0)"""
+        if not self.enabled:
+            return None, 0
+        try:
+            row = self._connect().execute(f"SELECT data, expires FROM {table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Falha ao ler {table} do armazém de metadados: {e}")
+            return None, 0
+        remaining = row[1] - time.time() if row else 0
+        if remaining <= 0:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        return json.loads(row[0]), remaining
+
+    def set(self, table, key, value, ttl=None):
+        if not self.enabled:
+            return
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        try:
+            conn = self._connect()
+            conn.execute(f"INSERT OR REPLACE INTO {table} (key, data, expires) VALUES (?, ?, ?)",
+                         (key, json.dumps(value, ensure_ascii=False), time.time() + ttl))
+            # Limpeza incremental das entradas vencidas
+            if random.random() < 0.01:
+                conn.execute(f"DELETE FROM {table} WHERE expires < ?", (time.time(),))
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Falha ao gravar {table} no armazém de metadados: {e}")
+
+    def stats(self):
+        counts = {}
+        if self.enabled:
+            try:
+                conn = self._connect()
+                for table in self.TABLES:
+                    counts[table] = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE expires >= ?",
+                                                 (time.time(),)).fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return {
+            'enabled': self.enabled,
+            'path': self.path,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'entries': counts,
+        }
+
+
+metadata_store = MetadataStore(METADATA_DB_PATH, METADATA_TTL)
+
+
+class SharedCacheServer:
+    """Cache em memória compartilhado pelos workers, servido num socket Unix.
+
+    Roda num processo próprio do supervisor. Cada conexão (do pool de um
+    worker) troca mensagens ('get'|'set', tabela, chave, ...) pelo protocolo
+    do multiprocessing.connection, autenticado com uma chave gerada pelo
+    supervisor e herdada pelos workers no fork.
+    """
+
+    def __init__(self, path, authkey, max_entries=SHARED_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.authkey = authkey
+        self.cache = TTLCache(max_entries, STREAM_CACHE_DEFAULT_TTL)
+
+    def _handle(self, conn):
+        try:
+            while True:
+                op, table, key, *rest = conn.recv()
+                if op == 'get':
+                    conn.send(self.cache.get_entry((table, key)))
+                elif op == 'set':
+                    value, ttl = rest
+                    self.cache.set((table, key), value, ttl=ttl)
+                elif op == 'stats':
+                    conn.send(self.cache.stats())
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = multiprocessing.connection.Listener(self.path, family='AF_UNIX', authkey=self.authkey)
+        os.chmod(self.path, 0o600)
+        while True:
+            try:
+                conn = listener.accept()
+            except (multiprocessing.AuthenticationError, OSError):
+                continue
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class SharedCache:
+    """Cliente do SharedCacheServer, com um pequeno pool de conexões por processo.
+
+    Cada chamada pega uma conexão ociosa do pool (ou abre uma) e a devolve ao
+    terminar; no máximo max_idle ficam abertas. Sem supervisor (path vazio)
+    fica desativado. Falhas de conexão viram miss e a reconexão espera um
+    segundo, para o cache nunca derrubar a requisição.
+    """
+
+    RETRY_DELAY = 1.0
+
+    def __init__(self, path=None, authkey=None, max_idle=8):
+        self.path = path
+        self.authkey = authkey
+        self.max_idle = max_idle
+        self._idle = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._down_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Conexões herdadas no fork pertencem ao processo pai
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        if time.monotonic() < self._down_until:
+            return None
+        return multiprocessing.connection.Client(self.path, family='AF_UNIX', authkey=self.authkey)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle and self._pid == os.getpid():
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _call(self, message, reply=True):
+        conn = None
+        try:
+            conn = self._acquire()
+            if conn is None:
+                return None
+            conn.send(message)
+            result = conn.recv() if reply else None
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            self.errors += 1
+            if conn is not None:
+                conn.close()
+            self._down_until = time.monotonic() + self.RETRY_DELAY
+            logger.warning(f"Cache compartilhado indisponível: {e}")
+            return None
+        self._release(conn)
+        return result
+
+    def get(self, table, key):
+        """(valor, segundos restantes), ou (None, 0)"""
+        if not self.enabled:
+            return None, 0
+        entry = self._call(('get', table, key))
+        if not entry or entry[0] is None:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        return entry
+
+    def set(self, table, key, value, ttl):
+        if self.enabled and ttl > 0:
+            self._call(('set', table, key, value, ttl), reply=False)
+
+    def stats(self):
+        out = {'enabled': self.enabled, 'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+        if self.enabled:
+            out['server'] = self._call(('stats', None, None))
+        return out
+
+
+# Configurado pelo supervisor (run_prefork) antes do fork dos workers
+shared_cache = SharedCache()
+
+
+def l2_get(table, key):
+    """Segundo nível dos caches: cache dos outros workers e, depois, o armazém SQLite"""
+    value, remaining = shared_cache.get(table, key)
+    if value is None:
+        value, remaining = metadata_store.get(table, key)
+        if value is not None:
+            shared_cache.set(table, key, value, remaining)
+    return value, remaining
+
+
+def l2_set(table, key, value, ttl):
+    shared_cache.set(table, key, value, ttl)
+    metadata_store.set(table, key, value, ttl=ttl)
+
+
+class InvidiousRegistry:
+    """Saúde das instâncias Invidious: taxa de sucesso, latência EWMA e circuit breaker.
+
+    Cada requisição real alimenta o placar (passivo); sondas periódicas são
+    opcionais. Após failure_threshold falhas seguidas a instância fica em
+    cooldown, dobrando a cada nova queda até max_cooldown.
+    """
+
+    EWMA_ALPHA = 0.3
+    # Latência presumida para instâncias ainda sem medição
+    DEFAULT_LATENCY = 1.0
+
+    def __init__(self, instances, failure_threshold=INVIDIOUS_FAILURE_THRESHOLD,
+                 cooldown=INVIDIOUS_COOLDOWN, max_cooldown=INVIDIOUS_MAX_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._state = {
+            instance: {'success': 0, 'failure': 0, 'consecutiveFailures': 0, 'trips': 0,
+                       'latency': None, 'cooldownUntil': 0.0}
+            for instance in instances
+        }
+
+    def record(self, instance, ok, latency=None):
+        with self._lock:
+            state = self._state.setdefault(instance, {
+                'success': 0, 'failure': 0, 'consecutiveFailures': 0, 'trips': 0,
+                'latency': None, 'cooldownUntil': 0.0})
+            if latency is not None:
+                prev = state['latency']
+                state['latency'] = latency if prev is None else (
+                    self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * prev)
+            if ok:
+                state['success'] += 1
+                state['consecutiveFailures'] = 0
+                state['trips'] = 0
+                state['cooldownUntil'] = 0.0
+                return
+            state['failure'] += 1
+            state['consecutiveFailures'] += 1
+            if state['consecutiveFailures'] >= self.failure_threshold:
+                state['trips'] += 1
+                state['consecutiveFailures'] = 0
+                backoff = min(self.cooldown * 2 ** (state['trips'] - 1), self.max_cooldown)
+                state['cooldownUntil'] = time.monotonic() + backoff
+                logger.warning(f"Instância Invidious {instance} em cooldown por {backoff:.0f}s")
+
+    def _score(self, state):
+        # Menor é melhor: latência esperada dividida pela taxa de sucesso (suavizada)
+        rate = (state['success'] + 1) / (state['success'] + state['failure'] + 2)
+        latency = state['latency'] if state['latency'] is not None else self.DEFAULT_LATENCY
+        return latency / rate
+
+    def ordered(self):
+        """Instâncias disponíveis por placar; se todas estão em cooldown, a que sai primeiro"""
+        now = time.monotonic()
+        with self._lock:
+            # Empate no placar mantém a ordem da configuração
+            available = [(self._score(st), i, inst) for i, (inst, st) in enumerate(self._state.items())
+                         if st['cooldownUntil'] <= now]
+            if available:
+                return [inst for _, _, inst in sorted(available)]
+            if not self._state:
+                return []
+            # Half-open: arrisca a instância cujo cooldown termina primeiro
+            return [min(self._state, key=lambda inst: self._state[inst]['cooldownUntil'])]
+
+    @traced('invidious')
+    def get_json(self, instance, path):
+        """GET na API da instância, registrando o resultado no placar"""
+        start = time.monotonic()
+        try:
+            response = upstream.get(f"{instance}{path}")
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            data = response.json()
+        except Exception:
+            self.record(instance, False, time.monotonic() - start)
+            raise
+        self.record(instance, True, time.monotonic() - start)
+        return data
+
+    def probe_all(self):
+        for instance in list(self._state):
+            try:
+                self.get_json(instance, '/api/v1/stats')
+            except Exception as e:
+                logger.info(f"Sonda Invidious falhou para {instance}: {e}")
+
+    def start_probes(self, interval=INVIDIOUS_PROBE_INTERVAL):
+        if interval <= 0:
+            return
+
+        def loop():
+            while True:
+                self.probe_all()
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name='invidious-probe', daemon=True).start()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                instance: {
+                    'success': st['success'],
+                    'failure': st['failure'],
+                    'latencyEwma': st['latency'],
+                    'score': self._score(st),
+                    'cooldownRemaining': max(st['cooldownUntil'] - now, 0.0),
+                }
+                for instance, st in self._state.items()
+            }
+
+
+# Placar das instâncias Invidious usadas nas buscas e no fallback de áudio
+invidious = InvidiousRegistry(INVIDIOUS_INSTANCES)
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,Authorization',
+    'Access-Control-Allow-Methods': 'GET,PUT,POST,DELETE,OPTIONS',
+    'Access-Control-Expose-Headers': 'Server-Timing,X-Request-ID,Retry-After',
+    'Timing-Allow-Origin': '*',
+}
+
+# Requisições em andamento (exposto em /metrics)
+inflight_requests = 0
+inflight_lock = threading.Lock()
+
+@app.before_request
+def track_request_start():
+    global inflight_requests
+    with inflight_lock:
+        inflight_requests += 1
+    trace = Trace(request.headers.get('X-Request-ID'))
+    if profiler.should_sample():
+        trace.profile = {}
+        profiler.register(trace)
+    g.trace_token = current_trace.set(trace)
+
+@app.teardown_request
+def track_request_end(exc=None):
+    global inflight_requests
+    with inflight_lock:
+        inflight_requests -= 1
+    trace = current_trace.get()
+    if trace is None:
+        return
+    if trace.profile is not None:
+        profiler.unregister()
+        if trace.elapsed() >= profiler.slow:
+            profiler.dump(trace, request.full_path)
+    logger.info(f"{request.method} {request.path} {g.get('status', '-')} {trace.elapsed() * 1000:.1f}ms",
+                extra={'fields': {'method': request.method, 'path': request.path, 'status': g.get('status'),
+                                  'durationMs': round(trace.elapsed() * 1000, 1), 'stages': trace.summary()}})
+    current_trace.reset(g.trace_token)
+
+class Overloaded(Exception):
+    """Sem capacidade de extração agora; vira 503 com Retry-After"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Endpoints que podem disparar extração e por isso passam pelo token bucket
+RATE_LIMITED_ENDPOINTS = {'search', 'stream', 'stream_batch', 'playlist', 'play_direct', 'transcode'}
+
+def request_cost():
+    """Fichas cobradas pela requisição: uma por vídeo em /stream/batch, senão uma"""
+    if request.endpoint == 'stream_batch':
+        payload = request.get_json(silent=True)
+        ids = payload.get('ids') if isinstance(payload, dict) else payload
+        if isinstance(ids, list) and ids:
+            return float(min(len(ids), BATCH_MAX_IDS))
+    return 1.0
+
+def client_key():
+    if RATE_LIMIT_TRUST_FORWARDED and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+@app.before_request
+def enforce_rate_limit():
+    if not rate_limiter.enabled or request.method == 'OPTIONS' or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    wait_for = rate_limiter.take(client_key(), request_cost())
+    if not wait_for:
+        return None
+    ADMISSION_REJECTED.inc('rate_limited')
+    retry_after = max(1, int(wait_for + 0.999))
+    response = jsonify({'error': 'Muitas requisições, tente novamente', 'retryAfter': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify({'error': str(e), 'retryAfter': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
 # Middleware CORS manual
 @app.after_request
 def after_request(response):
     # Ensure single-value CORS headers (avoid duplicate values like '*, *')
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
-    response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE,OPTIONS'
+    for name, value in CORS_HEADERS.items():
+        response.headers[name] = value
+    trace = current_trace.get()
+    if trace is not None:
+        g.status = response.status_code
+        response.headers['X-Request-ID'] = trace.id
+        response.headers['Server-Timing'] = trace.server_timing()
     return response
 
 # Configuração avançada do yt-dlp com headers aleatórios e opções para diferentes estratégias
@@ -67,27 +1562,546 @@ def get_ydl_fast_opts():
     opts['extract_flat'] = True
     return opts
 
+def get_ydl_fallback_opts():
+    opts = get_ydl_opts()
+    opts['extractor_args'] = {
+        'youtube': {
+            'player_client': ['android', 'ios', 'web'],
+            'player_skip': ['configs', 'webpage', 'js'],
+        }
+    }
+    return opts
+
+
+class YDLPool:
+    """Pool limitado de instâncias YoutubeDL reutilizáveis para um perfil de opções.
+
+    Cada instância é usada por uma thread de cada vez e é descartada após
+    max_uses usos ou quando a extração levanta exceção.
+    """
+
+    def __init__(self, name, opts_factory, size=YDL_POOL_SIZE, max_uses=YDL_POOL_MAX_USES):
+        self.name = name
+        self.opts_factory = opts_factory
+        self.size = size
+        self.max_uses = max_uses
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.recycled = 0
+        self.leases = 0
+
+    def _create(self):
+        ydl = youtube_dl.YoutubeDL(self.opts_factory())
+        with self._lock:
+            self.created += 1
+        return [ydl, 0]
+
+    def _retire(self, entry):
+        with self._lock:
+            self.recycled += 1
+        try:
+            close = getattr(entry[0], 'close', None)
+            if close:
+                close()
+        except Exception as e:
+            logger.warning(f"Erro ao fechar YoutubeDL ({self.name}): {e}")
+
+    @contextmanager
+    def lease(self):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+                self.leases += 1
+            if entry is None:
+                entry = self._create()
+            try:
+                yield entry[0]
+            except BaseException:
+                self._retire(entry)
+                raise
+            entry[1] += 1
+            if entry[1] >= self.max_uses:
+                self._retire(entry)
+            else:
+                with self._lock:
+                    self._idle.append(entry)
+        finally:
+            self._slots.release()
+
+    def warm(self, count=None):
+        """Cria instâncias antecipadamente até preencher o pool"""
+        count = self.size if count is None else min(count, self.size)
+        while True:
+            with self._lock:
+                if len(self._idle) >= count:
+                    return
+            entry = self._create()
+            with self._lock:
+                self._idle.append(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'created': self.created,
+                'recycled': self.recycled,
+                'leases': self.leases,
+            }
+
+
+# Um pool por perfil de opções do yt-dlp
+ydl_pools = {
+    'fast': YDLPool('fast', get_ydl_fast_opts),
+    'full': YDLPool('full', get_ydl_opts),
+    'fallback': YDLPool('fallback', get_ydl_fallback_opts),
+}
+
+
+YDL_OPTS_FACTORIES = {'fast': get_ydl_fast_opts, 'full': get_ydl_opts, 'fallback': get_ydl_fallback_opts}
+INFO_KEYS = ('id', 'title', 'duration', 'thumbnail', 'uploader', 'url', 'webpage_url', 'is_live', 'ext',
+             'format_id', 'acodec', 'vcodec', 'abr', 'tbr', 'filesize', 'filesize_approx')
+FORMAT_KEYS = ('format_id', 'url', 'ext', 'acodec', 'vcodec', 'abr', 'tbr', 'asr', 'filesize',
+               'filesize_approx', 'protocol', 'container')
+ENTRY_KEYS = ('id', 'title', 'duration', 'url')
+
+
+def compact_info(info):
+    """Reduz o info do yt-dlp aos campos usados aqui (barato de serializar entre processos)"""
+    if not info:
+        return info
+    out = {k: info[k] for k in INFO_KEYS if info.get(k) is not None}
+    if info.get('formats'):
+        out['formats'] = [{k: f[k] for k in FORMAT_KEYS if f.get(k) is not None} for f in info['formats']]
+    if info.get('entries') is not None:
+        out['entries'] = [{k: e[k] for k in ENTRY_KEYS if e.get(k) is not None} if e else None
+                          for e in info['entries']]
+    return out
+
+
+def extraction_worker(conn, initializer=None, initargs=()):
+    """Laço de um processo de extração: recebe (perfil, url) e devolve o info compacto"""
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send(('ready',))
+    ydls = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        profile, url = message
+        entry = ydls.get(profile)
+        if entry is None or entry[1] >= YDL_POOL_MAX_USES:
+            entry = ydls[profile] = [youtube_dl.YoutubeDL(YDL_OPTS_FACTORIES[profile]()), 0]
+        entry[1] += 1
+        try:
+            info = entry[0].extract_info(url, download=False)
+            conn.send(('ok', compact_info(info)))
+        except Exception as e:
+            ydls.pop(profile, None)
+            conn.send(('error', isinstance(e, youtube_dl.utils.DownloadError), str(e)))
+
+
+class ExtractionProcessPool:
+    """Pool de processos para o extract_info, fora do GIL das threads do Flask.
+
+    Cada processo atende uma chamada por vez por um Pipe. Se a resposta não
+    chega dentro do prazo, o processo é morto e substituído na próxima chamada;
+    as demais seguem nos processos restantes. Erros do yt-dlp voltam como
+    DownloadError para preservar a lógica de retry de safe_extract_info.
+    """
+
+    def __init__(self, size, timeout, initializer=None, initargs=()):
+        self.size = size
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self._ctx = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(max(size, 1))
+        self._idle = []
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.spawned = 0
+        self.killed = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=extraction_worker, name='ydl-worker', daemon=True,
+                                    args=(child_conn, self.initializer, self.initargs))
+        process.start()
+        child_conn.close()
+        with self._lock:
+            self.spawned += 1
+        return process, parent_conn
+
+    def _await_ready(self, worker, timeout=60):
+        """Espera o processo terminar os imports; o prazo das chamadas não inclui a subida"""
+        try:
+            if worker[1].poll(timeout) and worker[1].recv() == ('ready',):
+                return worker
+        except (EOFError, OSError):
+            pass
+        self._kill(worker)
+        raise RuntimeError('Processo de extração não iniciou')
+
+    def _spawn(self):
+        return self._await_ready(self._start())
+
+    def _kill(self, worker):
+        process, conn = worker
+        process.kill()
+        process.join(1)
+        conn.close()
+        with self._lock:
+            self.killed += 1
+
+    def extract_info(self, profile, url, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError('Nenhum processo de extração livre')
+        worker = None
+        try:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+                self.calls += 1
+            if worker is not None and not worker[0].is_alive():
+                self._kill(worker)
+                worker = None
+            if worker is None:
+                worker = self._spawn()
+            try:
+                worker[1].send((profile, url))
+                if not worker[1].poll(timeout):
+                    with self._lock:
+                        self.timeouts += 1
+                    raise TimeoutError(f"Extração excedeu {timeout:.0f}s: {url}")
+                status, *payload = worker[1].recv()
+            except (TimeoutError, EOFError, OSError):
+                self._kill(worker)
+                worker = None
+                raise
+        finally:
+            if worker is not None:
+                with self._lock:
+                    self._idle.append(worker)
+            self._slots.release()
+        if status == 'ok':
+            return payload[0]
+        with self._lock:
+            self.errors += 1
+        is_download_error, message = payload
+        if is_download_error:
+            raise youtube_dl.utils.DownloadError(message)
+        raise RuntimeError(message)
+
+    def warm(self):
+        """Inicia os processos antecipadamente (o import do yt-dlp leva segundos)"""
+        workers = [self._await_ready(worker) for worker in [self._start() for _ in range(self.size)]]
+        with self._lock:
+            self._idle.extend(workers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'timeoutS': self.timeout,
+                'calls': self.calls,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'spawned': self.spawned,
+                'killed': self.killed,
+            }
+
+
+class PooledYDL:
+    """Fachada com o extract_info de um YoutubeDL, executado no pool de processos"""
+
+    def __init__(self, pool, profile):
+        self.pool = pool
+        self.profile = profile
+        self.params = {}
+
+    def extract_info(self, url, download=False):
+        return self.pool.extract_info(self.profile, url)
+
+
+extraction_pool = ExtractionProcessPool(EXTRACT_PROCESSES, EXTRACT_TIMEOUT)
+
+
+@contextmanager
+def ydl_lease(profile):
+    """YoutubeDL de um perfil: no pool de processos quando ativo, senão no pool de threads"""
+    if extraction_pool.enabled:
+        yield PooledYDL(extraction_pool, profile)
+        return
+    with ydl_pools[profile].lease() as ydl:
+        yield ydl
+
+
+# Marca o contexto de trabalho em segundo plano; segue para as threads do resolver via copy_context
+background_work = contextvars.ContextVar('background_work', default=False)
+
+
+class AdmissionController:
+    """Limita as extrações simultâneas com uma fila de espera limitada.
 
-def safe_extract_info(ydl, url, retry_count=3):
-    """Extrai informações com retry em caso de erro e detecção de bloqueio por bot."""
+    Cada chamada ao extract_info ocupa uma vaga só enquanto executa; as esperas
+    de backoff entre tentativas acontecem fora dela. Com a fila cheia a
+    recusa é imediata; na fila, a espera é limitada a queue_timeout.
+
+    Trabalho em segundo plano (background_work, ex.: pré-busca) nunca entra na
+    fila: só pega uma vaga livre na hora, sem ninguém esperando, e deixa ao
+    menos uma vaga para as requisições dos usuários.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.avg_hold = 1.0
+
+    def retry_after(self):
+        """Segundos estimados até haver vaga, pela duração média das extrações"""
+        with self._lock:
+            backlog = self.waiting + self.active
+        return max(1, int(self.avg_hold * backlog / self.max_concurrent + 0.999))
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected += 1
+        ADMISSION_REJECTED.inc(reason)
+        raise Overloaded('Servidor sobrecarregado, tente novamente', self.retry_after())
+
+    def idle_for_background(self):
+        """Há vaga para trabalho em segundo plano sem atrasar nenhum usuário"""
+        with self._lock:
+            return self.waiting == 0 and self.active < max(self.max_concurrent - 1, 1)
+
+    def admit(self):
+        """Recusa já na entrada se a fila estiver cheia (antes de qualquer trabalho)"""
+        if self.waiting >= self.max_queue:
+            self._reject('queue_full')
+
+    @contextmanager
+    def slot(self):
+        start = time.monotonic()
+        if background_work.get():
+            if not (self.idle_for_background() and self._slots.acquire(blocking=False)):
+                self._reject('background')
+        else:
+            with self._lock:
+                full = self.waiting >= self.max_queue
+                if not full:
+                    self.waiting += 1
+            if full:
+                self._reject('queue_full')
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            waited = time.monotonic() - start
+            if not acquired:
+                EXTRACT_QUEUE_WAIT_SECONDS.observe(waited, 'timeout')
+                self._reject('queue_timeout')
+            EXTRACT_QUEUE_WAIT_SECONDS.observe(waited, 'admitted')
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        held = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - held
+            with self._lock:
+                self.active -= 1
+                self.avg_hold = 0.8 * self.avg_hold + 0.2 * elapsed
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'maxConcurrent': self.max_concurrent,
+                'maxQueue': self.max_queue,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avgHoldS': round(self.avg_hold, 3),
+            }
+
+
+extraction_admission = AdmissionController(EXTRACT_CONCURRENCY, EXTRACT_QUEUE_SIZE, EXTRACT_QUEUE_TIMEOUT)
+
+
+def admitted_extract(ydl, url, **kwargs):
+    """extract_info ocupando uma vaga de extração"""
+    start = time.monotonic()
+    with extraction_admission.slot():
+        trace_add('queue', time.monotonic() - start)
+        with span('extract'):
+            return ydl.extract_info(url, download=False, **kwargs)
+
+
+class RateLimiter:
+    """Token bucket por cliente (LRU limitado a max_clients buckets)"""
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def take(self, client, cost=1.0):
+        """0 se liberado; senão, segundos até haver fichas suficientes.
+
+        Um custo acima do burst passa com o bucket cheio e deixa o saldo
+        negativo, para que pedidos grandes (lotes) não sejam recusados sempre.
+        """
+        now = time.monotonic()
+        needed = min(cost, self.burst)
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= needed:
+                wait_for = 0
+                tokens -= cost
+            else:
+                wait_for = (needed - tokens) / self.rate
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait_for
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'clients': len(self._buckets), 'limited': self.limited}
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+
+def warm_ydl_pools():
+    """Pré-aquece os pools de YoutubeDL (registro de extratores etc.)"""
+    start = time.monotonic()
+    if extraction_pool.enabled:
+        extraction_pool.warm()
+    else:
+        for pool in ydl_pools.values():
+            pool.warm()
+    logger.info(f"Pools YoutubeDL aquecidos em {time.monotonic() - start:.2f}s")
+
+
+class Warmup:
+    """Aquecimento em segundo plano depois que o servidor sobe; o /ready reflete o estado.
+
+    Importa o yt-dlp e prepara os pools de YoutubeDL (ou os processos de
+    extração) sem bloquear o bind da porta; requisições que cheguem antes
+    apenas pagam o import sob demanda. Se algum passo falhar o processo não
+    fica pronto: o erro aparece no /ready, que segue respondendo 503.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.steps = {}
+        self.error = None
+        self.started_at = None
+
+    def _step(self, name, fn):
+        start = time.monotonic()
+        fn()
+        self.steps[name] = round(time.monotonic() - start, 3)
+
+    def _run(self):
+        try:
+            self._step('importYtDlp', youtube_dl.load)
+            self._step('ydlPools', warm_ydl_pools)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.error(f"Falha no aquecimento: {e}")
+            return
+        self.ready.set()
+        logger.info(f"Pronto em {time.monotonic() - PROCESS_STARTED:.2f}s desde o início do processo")
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+            threading.Thread(target=self._run, name='warmup', daemon=True).start()
+
+    def stats(self):
+        return {
+            'ready': self.ready.is_set(),
+            'warmupStarted': self.started_at is not None,
+            'steps': dict(self.steps),
+            'error': self.error,
+            'uptimeS': round(time.monotonic() - PROCESS_STARTED, 3),
+        }
+
+
+warmup = Warmup()
+
+
+def safe_extract_info(ydl, url, retry_count=3, cancel=None):
+    """Extrai informações com retry em caso de erro e detecção de bloqueio por bot.
+
+    Se o evento cancel for sinalizado durante a espera entre tentativas, desiste
+    e retorna None. A espera de backoff libera a vaga de extração (cada
+    tentativa ocupa uma só enquanto executa), mas continua bloqueando a
+    thread chamadora: a requisição precisa do resultado de qualquer forma.
+    """
     for attempt in range(retry_count):
         try:
             # Delay aleatório entre tentativas
             if attempt > 0:
-                time.sleep(random.uniform(1, 3))
+                delay = random.uniform(1, 3)
+                with span('backoff'):
+                    if cancel is not None:
+                        if cancel.wait(delay):
+                            return None
+                    else:
+                        time.sleep(delay)
                 # rotate user-agent header if available
                 if 'http_headers' in ydl.params:
                     ua_list = ydl.params['http_headers'].get('User-Agent')
-            info = ydl.extract_info(url, download=False)
+            info = admitted_extract(ydl, url)
             return info
         except youtube_dl.utils.DownloadError as e:
             if "bot" in str(e).lower() or "sign in" in str(e).lower():
                 logger.warning(f"Detectado bloqueio de bot (tentativa {attempt + 1})")
                 if attempt == retry_count - 1:
                     raise e
+                BOT_RETRIES.inc()
                 continue
             else:
                 raise e
+        except Overloaded:
+            raise
         except Exception as e:
             if attempt == retry_count - 1:
                 raise e
@@ -113,27 +2127,18 @@ def alternative_search(query):
 def search_via_invidious(query):
     """Busca usando instância Invidious alternativa"""
     try:
-        instances = [
-            'https://inv.riverside.rocks',
-            'https://invidious.snopyta.org',
-            'https://yewtu.be',
-            'https://invidious.kanicloud.com'
-        ]
-        for instance in instances:
+        for instance in invidious.ordered():
             try:
-                search_url = f"{instance}/api/v1/search?q={quote(query)}&type=video"
-                response = requests.get(search_url, timeout=10)
-                if response.status_code == 200:
-                    data = response.json()
-                    videos = []
-                    for item in data[:10]:
-                        videos.append({
-                            'id': item.get('videoId'),
-                            'title': item.get('title', 'Sem título'),
-                            'duration': format_duration(item.get('lengthSeconds', 0)),
-                            'isVideo': True
-                        })
-                    return videos
+                data = invidious.get_json(instance, f"/api/v1/search?q={quote(query)}&type=video")
+                videos = []
+                for item in data[:10]:
+                    videos.append({
+                        'id': item.get('videoId'),
+                        'title': item.get('title', 'Sem título'),
+                        'duration': format_duration(item.get('lengthSeconds', 0)),
+                        'isVideo': True
+                    })
+                return videos
             except Exception:
                 continue
         return []
@@ -141,118 +2146,127 @@ def search_via_invidious(query):
         return []
 
 
-def fast_search(query):
-    """Busca rápida no YouTube com proteção anti-bot"""
-    try:
-        ydl_opts = get_ydl_fast_opts()
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            # Verifica se é URL direta
-            video_id = extract_video_id(query)
-            playlist_id = extract_playlist_id(query)
-            if video_id:
-                url = f"https://www.youtube.com/watch?v={video_id}"
-                info = safe_extract_info(ydl, url)
-                if not info:
-                    return []
-                return [{
-                    'id': info.get('id'),
-                    'title': info.get('title', 'Sem título'),
-                    'duration': format_duration(info.get('duration', 0)),
-                    'isVideo': True,
-                    'url': url
-                }]
-            elif playlist_id:
-                url = f"https://www.youtube.com/playlist?list={playlist_id}"
-                info = safe_extract_info(ydl, url)
-                if not info:
-                    return []
-                videos = []
-                for entry in info.get('entries', [])[:20]:
-                    if entry:
-                        videos.append({
-                            'id': entry.get('id'),
-                            'title': entry.get('title', 'Sem título'),
-                            'duration': format_duration(entry.get('duration', 0)),
-                            'isVideo': True,
-                            'url': entry.get('url')
-                        })
-                return videos
-            else:
-                # Busca por texto usando método alternativo
-                return alternative_search(query)
-    except Exception as e:
-        logger.error(f"Erro na busca rápida: {e}")
-        return alternative_search(query)
+# Teto de bitrate (kbps) de cada nível de ?quality=; None é o melhor disponível
+QUALITY_MAX_KBPS = {'low': 64, 'medium': 140, 'high': None}
+FORMAT_INDEX_PUBLIC = ('itag', 'codec', 'kbps', 'filesize', 'container', 'audioOnly')
 
 
-def get_audio_url(video_id):
-    """Obtém URL de áudio com múltiplas estratégias"""
-    strategies = [
-        get_audio_direct,
-        get_audio_via_invidious,
-        get_audio_fallback
-    ]
-    for strategy in strategies:
-        try:
-            result = strategy(video_id)
-            if result and result.get('success'):
-                return result
-        except Exception as e:
-            logger.warning(f"Estratégia {strategy.__name__} falhou: {e}")
+def build_format_index(info):
+    """Índice compacto dos formatos com áudio de um info do yt-dlp.
+
+    Cada entrada tem itag, codec, kbps, filesize, container, audioOnly e url;
+    os só de áudio vêm primeiro, do maior para o menor bitrate.
+    """
+    index = []
+    for f in info.get('formats') or []:
+        if not f.get('url') or f.get('acodec') in (None, 'none') or f.get('protocol', 'https').startswith('m3u8'):
             continue
-    return {'success': False, 'error': 'Todas as estratégias falharam'}
+        index.append({
+            'itag': f.get('format_id'),
+            'codec': f.get('acodec'),
+            'kbps': round(f.get('abr') or f.get('tbr') or 0),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+            'container': f.get('ext'),
+            'audioOnly': f.get('vcodec') in (None, 'none'),
+            'url': f['url'],
+        })
+    if not index and info.get('url'):
+        # Info já resolvido para um único formato (ex.: format=bestaudio)
+        index.append({'itag': info.get('format_id'), 'codec': info.get('acodec'),
+                      'kbps': round(info.get('abr') or info.get('tbr') or 0),
+                      'filesize': info.get('filesize') or info.get('filesize_approx'),
+                      'container': info.get('ext'), 'audioOnly': info.get('vcodec') in (None, 'none'),
+                      'url': info['url']})
+    index.sort(key=lambda f: (not f['audioOnly'], -f['kbps']))
+    return index
+
+
+def select_format(index, max_kbps=None):
+    """Formato só de áudio de maior bitrate até max_kbps (ou o menor, se nenhum couber).
+
+    Formatos com vídeo só entram quando não há nenhum só de áudio.
+    """
+    candidates = [f for f in index if f['audioOnly']] or index
+    if not candidates:
+        return None
+    if max_kbps is None:
+        return candidates[0]
+    fitting = [f for f in candidates if f['kbps'] <= max_kbps]
+    return fitting[0] if fitting else min(candidates, key=lambda f: f['kbps'])
+
+
+def public_format(fmt):
+    """Entrada do índice sem a URL assinada"""
+    return {k: fmt.get(k) for k in FORMAT_INDEX_PUBLIC}
 
 
-def get_audio_direct(video_id):
+def get_audio_direct(video_id, cancel=None):
     """Estratégia direta com yt-dlp"""
     try:
-        ydl_opts = get_ydl_opts()
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        with ydl_lease('full') as ydl:
             url = f"https://www.youtube.com/watch?v={video_id}"
-            info = safe_extract_info(ydl, url)
-            if not info:
+            info = safe_extract_info(ydl, url, cancel=cancel)
+            formats = build_format_index(info) if info else []
+            best = select_format(formats)
+            if not best:
                 return {'success': False}
             return {
                 'success': True,
-                'audioUrl': info.get('url'),
+                'audioUrl': best['url'],
+                'formats': formats,
                 'title': info.get('title', 'Sem título'),
                 'duration': info.get('duration', 0),
                 'thumbnail': info.get('thumbnail', ''),
                 'channel': info.get('uploader', '')
             }
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro no método direto: {e}")
         return {'success': False}
 
 
-def get_audio_via_invidious(video_id):
+def invidious_format_index(data):
+    """Índice de formatos (mesmo formato de build_format_index) a partir dos adaptiveFormats"""
+    index = []
+    for fmt in data.get('adaptiveFormats', []):
+        mime = fmt.get('type', '')
+        if not mime.startswith('audio/') or not fmt.get('url'):
+            continue
+        codec = re.search(r'codecs="([^"]+)"', mime)
+        index.append({
+            'itag': str(fmt.get('itag', '')),
+            'codec': codec.group(1) if codec else None,
+            'kbps': round(int(fmt.get('bitrate') or 0) / 1000),
+            'filesize': int(fmt['clen']) if str(fmt.get('clen', '')).isdigit() else None,
+            'container': fmt.get('container') or mime.split(';')[0].split('/')[-1],
+            'audioOnly': True,
+            'url': fmt['url'],
+        })
+    index.sort(key=lambda f: -f['kbps'])
+    return index
+
+
+def get_audio_via_invidious(video_id, cancel=None):
     """Estratégia usando Invidious para obter áudio"""
     try:
-        instances = [
-            'https://inv.riverside.rocks',
-            'https://invidious.snopyta.org',
-            'https://yewtu.be'
-        ]
-        for instance in instances:
+        for instance in invidious.ordered():
+            if cancel is not None and cancel.is_set():
+                break
             try:
-                api_url = f"{instance}/api/v1/videos/{video_id}"
-                response = requests.get(api_url, timeout=10)
-                if response.status_code == 200:
-                    data = response.json()
-                    best_audio = None
-                    for fmt in data.get('adaptiveFormats', []):
-                        if (fmt.get('type', '').startswith('audio/') and fmt.get('url')):
-                            if not best_audio or fmt.get('bitrate', 0) > best_audio.get('bitrate', 0):
-                                best_audio = fmt
-                    if best_audio:
-                        return {
-                            'success': True,
-                            'audioUrl': best_audio['url'],
-                            'title': data.get('title', 'Sem título'),
-                            'duration': data.get('lengthSeconds', 0),
-                            'thumbnail': data.get('videoThumbnails', [{}])[0].get('url', ''),
-                            'channel': data.get('author', '')
-                        }
+                data = invidious.get_json(instance, f"/api/v1/videos/{video_id}")
+                formats = invidious_format_index(data)
+                best = select_format(formats)
+                if best:
+                    return {
+                        'success': True,
+                        'audioUrl': best['url'],
+                        'formats': formats,
+                        'title': data.get('title', 'Sem título'),
+                        'duration': data.get('lengthSeconds', 0),
+                        'thumbnail': data.get('videoThumbnails', [{}])[0].get('url', ''),
+                        'channel': data.get('author', '')
+                    }
             except Exception:
                 continue
         return {'success': False}
@@ -261,27 +2275,27 @@ def get_audio_via_invidious(video_id):
         return {'success': False}
 
 
-def get_audio_fallback(video_id):
+def get_audio_fallback(video_id, cancel=None):
     """Estratégia de fallback usando métodos públicos"""
     try:
         fallback_url = f"https://www.youtube.com/watch?v={video_id}"
-        ydl_opts = get_ydl_opts()
-        ydl_opts['extractor_args'] = {
-            'youtube': {
-                'player_client': ['android', 'ios', 'web'],
-                'player_skip': ['configs', 'webpage', 'js'],
-            }
-        }
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(fallback_url, download=False)
+        with ydl_lease('fallback') as ydl:
+            info = admitted_extract(ydl, fallback_url)
+            formats = build_format_index(info) if info else []
+            best = select_format(formats)
+            if not best:
+                return {'success': False}
             return {
                 'success': True,
-                'audioUrl': info.get('url'),
+                'audioUrl': best['url'],
+                'formats': formats,
                 'title': info.get('title', 'Sem título'),
                 'duration': info.get('duration', 0),
                 'thumbnail': info.get('thumbnail', ''),
                 'channel': info.get('uploader', '')
             }
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro no método fallback: {e}")
         return {'success': False}
@@ -290,7 +2304,7 @@ def extract_video_id(url_or_query):
     """Extrai o ID do vídeo de forma rápida"""
     patterns = [
         r'(?:v=|youtu\.be/|embed/)([^&?/\n]{11})',
-        r'^[a-zA-Z0-9_-]{11}$'
+        r'^([a-zA-Z0-9_-]{11})$'
     ]
     
     for pattern in patterns:
@@ -304,18 +2318,62 @@ def extract_playlist_id(url):
     match = re.search(r'[&?]list=([^&]+)', url)
     return match.group(1) if match else None
 
+def search_key(query):
+    """Normaliza a busca: IDs para URLs, minúsculas e espaços colapsados para texto"""
+    video_id = extract_video_id(query)
+    if video_id:
+        return f"video:{video_id}"
+    playlist_id = extract_playlist_id(query)
+    if playlist_id:
+        return f"playlist:{playlist_id}"
+    return 'search:' + ' '.join(query.lower().split())
+
+@traced('search')
 def fast_search(query):
+    """Busca rápida no YouTube com cache e compartilhamento de buscas em andamento"""
+    start = time.monotonic()
+    key = search_key(query)
+    query_type = key.split(':', 1)[0]
+    results = search_cache.get(key)
+    if results is None:
+        # L2: buscas de outros workers ou persistidas por execuções anteriores
+        results, remaining = l2_get('searches', key)
+        if results is not None:
+            search_cache.set(key, results, ttl=remaining)
+    if results is not None:
+        logger.info(f"Cache hit para busca: {key}")
+        SEARCH_SECONDS.observe(time.monotonic() - start, query_type, 'hit')
+        return results
+    try:
+        return extraction_flight.do(key, search_and_cache, key, query)
+    finally:
+        SEARCH_SECONDS.observe(time.monotonic() - start, query_type, 'miss')
+
+def search_and_cache(key, query):
+    """Executa a busca e guarda resultados não vazios no cache de buscas"""
+    extraction_admission.admit()
+    results = _fast_search(query)
+    if results:
+        ttl = PLAYLIST_CACHE_TTL if key.startswith('playlist:') else SEARCH_CACHE_TTL
+        search_cache.set(key, results, ttl=ttl)
+        l2_set('searches', key, results, ttl)
+    return results
+
+def _fast_search(query):
     """Busca rápida no YouTube"""
     try:
-        ydl_opts = get_ydl_fast_opts()
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            # Verifica se é URL direta
-            video_id = extract_video_id(query)
-            playlist_id = extract_playlist_id(query)
-            
+        # Verifica se é URL direta
+        video_id = extract_video_id(query)
+        playlist_id = extract_playlist_id(query)
+
+        if playlist_id and not video_id:
+            # Primeira página; as seguintes via /playlist/<id>?offset=
+            return playlist_page(playlist_id, 0, PLAYLIST_PAGE_SIZE)['entries']
+
+        with ydl_lease('fast') as ydl:
             if video_id:
                 url = f"https://www.youtube.com/watch?v={video_id}"
-                info = ydl.extract_info(url, download=False)
+                info = admitted_extract(ydl, url)
                 return [{
                     'id': info.get('id'),
                     'title': info.get('title', 'Sem título'),
@@ -324,25 +2382,10 @@ def fast_search(query):
                     'url': url
                 }]
             
-            elif playlist_id:
-                url = f"https://www.youtube.com/playlist?list={playlist_id}"
-                info = ydl.extract_info(url, download=False)
-                videos = []
-                for entry in info.get('entries', [])[:50]:  # Limita a 50 músicas
-                    if entry:
-                        videos.append({
-                            'id': entry.get('id'),
-                            'title': entry.get('title', 'Sem título'),
-                            'duration': format_duration(entry.get('duration', 0)),
-                            'isVideo': True,
-                            'url': entry.get('url')
-                        })
-                return videos
-            
             else:
                 # Busca por texto - método mais rápido
                 search_query = f"ytsearch10:{query}"
-                info = ydl.extract_info(search_query, download=False)
+                info = admitted_extract(ydl, search_query)
                 videos = []
                 for entry in info.get('entries', [])[:10]:
                     if entry:
@@ -355,54 +2398,407 @@ def fast_search(query):
                         })
                 return videos
                 
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro na busca rápida: {e}")
         return []
 
-def get_audio_url(video_id):
-    """Obtém URL de áudio de forma rápida"""
+
+class PlaylistCursor:
+    """Leitura preguiçosa de uma playlist pelo iterador paginado do yt-dlp.
+
+    As entradas já lidas ficam guardadas; pedir um offset além delas só busca
+    as páginas que faltam. Usa um YoutubeDL próprio (fora do pool), já que o
+    iterador continua vivo entre requisições.
+    """
+
+    def __init__(self, playlist_id):
+        self.playlist_id = playlist_id
+        self.title = None
+        self.entries = []
+        self.exhausted = False
+        self._iter = None
+        self._ydl = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self._ydl = youtube_dl.YoutubeDL(get_ydl_fast_opts())
+        url = f"https://www.youtube.com/playlist?list={self.playlist_id}"
+        # process=False mantém 'entries' como iterador (páginas sob demanda)
+        info = self._ydl.extract_info(url, download=False, process=False)
+        if not info:
+            raise RuntimeError('Playlist não encontrada')
+        self.title = info.get('title')
+        self._iter = iter(info.get('entries') or [])
+
+    def _fetch_until(self, count):
+        """Lê do iterador até ter count entradas (ou a playlist acabar); chamar com _lock.
+
+        Só ocupa uma vaga de extração quando precisa buscar no yt-dlp.
+        """
+        if len(self.entries) >= count or self.exhausted:
+            return
+        with extraction_admission.slot():
+            if self._iter is None:
+                self._open()
+            self._read_until(count)
+
+    def _read_until(self, count):
+        while len(self.entries) < count and not self.exhausted:
+            try:
+                entry = next(self._iter)
+            except StopIteration:
+                self.exhausted = True
+                self._iter = self._ydl = None
+                break
+            if entry:
+                self.entries.append({
+                    'id': entry.get('id'),
+                    'title': entry.get('title', 'Sem título'),
+                    'duration': format_duration(entry.get('duration', 0)),
+                    'isVideo': True,
+                    'url': entry.get('url')
+                })
+
+    def page(self, offset, limit):
+        with self._lock:
+            self._fetch_until(offset + limit + 1)
+            return self.entries[offset:offset + limit], len(self.entries) > offset + limit
+
+    def iter_entries(self, offset, limit):
+        """Gera as entradas uma a uma, buscando páginas conforme o consumo"""
+        for index in range(offset, offset + limit):
+            with self._lock:
+                self._fetch_until(index + 1)
+                if index >= len(self.entries):
+                    return
+                entry = self.entries[index]
+            yield entry
+
+
+# Cursores de playlist por ID, com as páginas já lidas
+playlist_cursors = TTLCache(PLAYLIST_CURSOR_MAX_ENTRIES, PLAYLIST_CACHE_TTL)
+playlist_cursors_lock = threading.Lock()
+
+def get_playlist_cursor(playlist_id):
+    with playlist_cursors_lock:
+        cursor = playlist_cursors.get(playlist_id)
+        if cursor is None:
+            cursor = PlaylistCursor(playlist_id)
+            playlist_cursors.set(playlist_id, cursor)
+        return cursor
+
+def drop_playlist_cursor(playlist_id):
+    with playlist_cursors_lock:
+        playlist_cursors.delete(playlist_id)
+
+def playlist_page(playlist_id, offset, limit):
+    """Página de uma playlist: entradas, título e o próximo offset (None no fim)"""
+    cursor = get_playlist_cursor(playlist_id)
     try:
-        url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        ydl_opts = get_ydl_opts()
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            # Try to obtain a usable media URL. Some info dicts contain 'url' directly,
-            # otherwise pick a best audio format from 'formats'.
-            audio_url = info.get('url')
-            if not audio_url and 'formats' in info:
-                # prefer audio-only formats
-                formats = info.get('formats', [])
-                # pick the first audio-only or the best available
-                chosen = None
-                for f in formats:
-                    if f.get('acodec') and f.get('vcodec') in (None, 'none'):
-                        chosen = f
-                        break
-                if not chosen and formats:
-                    chosen = formats[-1]
-                if chosen:
-                    audio_url = chosen.get('url')
+        entries, has_more = cursor.page(offset, limit)
+    except Overloaded:
+        # Recusada antes de tocar no iterador: o cursor continua válido
+        raise
+    except Exception:
+        drop_playlist_cursor(playlist_id)
+        raise
+    return {
+        'id': playlist_id,
+        'title': cursor.title,
+        'offset': offset,
+        'entries': entries,
+        'nextOffset': offset + len(entries) if has_more else None,
+    }
 
-            if not audio_url:
-                raise RuntimeError('No audio URL found')
+class HedgedResolver:
+    """Executa as estratégias de áudio como uma corrida escalonada (hedged).
 
-            # Return a proxied URL so the browser fetches from our server (fixes CORS).
-            proxied = f"{request.scheme}://{request.host}/proxy?url={urllib.parse.quote_plus(audio_url)}"
+    A primeira estratégia começa imediatamente; a próxima é lançada após
+    hedge_delay segundos sem resposta ou assim que uma falha. O primeiro
+    sucesso vence e as demais são canceladas (as ainda não iniciadas não
+    rodam; as em execução recebem o evento cancel).
 
-            return {
-                'success': True,
-                'audioUrl': proxied,
-                'title': info.get('title', 'Sem título'),
-                'duration': info.get('duration', 0),
-                'thumbnail': info.get('thumbnail', ''),
-                'channel': info.get('uploader', '')
-            }
-                
+    Uma estratégia recusada pelo controle de admissão (Overloaded) não lança
+    a próxima: as já em execução seguem até o fim e, sem sucesso, a recusa
+    é repassada ao chamador (503 com Retry-After).
+    """
+
+    def __init__(self, strategies, hedge_delay=HEDGE_DELAY, timeout=RESOLVE_TIMEOUT, max_workers=RESOLVER_WORKERS):
+        self.strategies = strategies
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='resolver')
+        self._lock = threading.Lock()
+        self._stats = {s.__name__: {'started': 0, 'success': 0, 'failure': 0, 'cancelled': 0, 'rejected': 0,
+                                    'latencyTotal': 0.0, 'latencyMax': 0.0}
+                       for s in strategies}
+
+    def _record(self, name, outcome, elapsed=None):
+        with self._lock:
+            stats = self._stats[name]
+            stats[outcome] += 1
+            if elapsed is not None:
+                stats['latencyTotal'] += elapsed
+                stats['latencyMax'] = max(stats['latencyMax'], elapsed)
+
+    def _run(self, strategy, video_id, cancel):
+        if cancel.is_set():
+            return None
+        name = strategy.__name__
+        self._record(name, 'started')
+        start = time.monotonic()
+        try:
+            with profiler.watch(current_trace.get()):
+                result = strategy(video_id, cancel=cancel)
+        except Overloaded:
+            self._record(name, 'rejected')
+            EXTRACT_SECONDS.observe(time.monotonic() - start, name, 'rejected')
+            raise
+        except Exception as e:
+            logger.warning(f"Estratégia {name} falhou: {e}")
+            result = None
+        elapsed = time.monotonic() - start
+        trace_add(f"hedge.{name.replace('get_audio_', '')}", elapsed)
+        if result and result.get('success'):
+            self._record(name, 'success', elapsed)
+            EXTRACT_SECONDS.observe(elapsed, name, 'success')
+        elif cancel.is_set():
+            self._record(name, 'cancelled')
+            EXTRACT_SECONDS.observe(elapsed, name, 'cancelled')
+        else:
+            self._record(name, 'failure', elapsed)
+            EXTRACT_SECONDS.observe(elapsed, name, 'failure')
+        return result
+
+    def resolve(self, video_id):
+        cancel = threading.Event()
+        remaining = list(self.strategies)
+        pending = set()
+        deadline = time.monotonic() + self.timeout
+
+        def launch():
+            strategy = remaining.pop(0)
+            # copy_context leva o trace da requisição para a thread do resolver
+            pending.add(self._executor.submit(contextvars.copy_context().run, self._run, strategy, video_id, cancel))
+
+        launch()
+        overloaded = None
+        try:
+            while pending:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                wait_for = min(self.hedge_delay, left) if remaining and not overloaded else left
+                done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    try:
+                        result = future.result()
+                    except Overloaded as e:
+                        overloaded = e
+                        continue
+                    if result and result.get('success'):
+                        return result
+                # Timeout do hedge ou falha: lança a próxima estratégia (nunca sob recusa)
+                if remaining and not overloaded:
+                    launch()
+        finally:
+            cancel.set()
+            for future in pending:
+                future.cancel()
+        if overloaded:
+            raise overloaded
+        raise RuntimeError('Todas as estratégias falharam')
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for name, stats in self._stats.items():
+                finished = stats['success'] + stats['failure']
+                out[name] = dict(stats, latencyAvg=stats['latencyTotal'] / finished if finished else 0.0)
+            return out
+
+
+# Resolução de áudio: direto (yt-dlp) -> Invidious -> fallback, em corrida escalonada
+audio_resolver = HedgedResolver([get_audio_direct, get_audio_via_invidious, get_audio_fallback])
+
+
+def resolve_audio(video_id):
+    """Obtém a URL de áudio original (googlevideo) e os metadados do vídeo"""
+    return audio_resolver.resolve(video_id)
+
+
+METADATA_FIELDS = ('title', 'duration', 'thumbnail', 'channel')
+
+
+def resolve_and_cache_audio(video_id):
+    """Resolve o áudio e guarda no cache de streams, no cache compartilhado e no armazém"""
+    resolved, remaining = l2_get('streams', video_id)
+    if resolved is not None:
+        ttl = min(remaining, url_expiry_ttl(resolved['audioUrl']))
+        if ttl > 0:
+            stream_cache.set(video_id, resolved, ttl=ttl)
+            return resolved
+    extraction_admission.admit()
+    resolved = resolve_audio(video_id)
+    ttl = url_expiry_ttl(resolved['audioUrl'])
+    stream_cache.set(video_id, resolved, ttl=ttl)
+    l2_set('streams', video_id, resolved, ttl)
+    metadata_store.set('videos', video_id, {field: resolved.get(field) for field in METADATA_FIELDS})
+    return resolved
+
+
+def get_video_metadata(video_id):
+    """Metadados (título, duração, thumbnail, canal) sem extrair, ou None se desconhecidos"""
+    resolved = stream_cache.get(video_id)
+    if resolved is not None:
+        return {field: resolved.get(field) for field in METADATA_FIELDS}
+    return metadata_store.get('videos', video_id)[0]
+
+
+def proxy_base_url():
+    """Base das URLs do /proxy: o motor assíncrono quando ativo, senão este servidor"""
+    if async_proxy.running:
+        if ASYNC_PROXY_PUBLIC_URL:
+            return ASYNC_PROXY_PUBLIC_URL
+        return f"{request.scheme}://{request.host.rsplit(':', 1)[0]}:{async_proxy.port}"
+    return f"{request.scheme}://{request.host}"
+
+
+@traced('resolve')
+def get_resolved_audio(video_id):
+    """Áudio resolvido (URL original do googlevideo) do cache ou de uma extração compartilhada"""
+    resolved = stream_cache.get(video_id)
+    if resolved is None:
+        return extraction_flight.do(f"stream:{video_id}", resolve_and_cache_audio, video_id)
+    logger.info(f"Cache hit para: {video_id}")
+    return resolved
+
+
+@traced('select')
+def choose_audio_format(resolved, max_kbps=None):
+    """Formato para um teto de bitrate, escolhido no índice em cache e memorizado junto dele"""
+    index = resolved.get('formats')
+    if not index:
+        # Entradas antigas do armazém, sem índice: só há a URL padrão
+        return {'url': resolved['audioUrl']}
+    selected = resolved.setdefault('selected', {})
+    key = str(max_kbps)
+    itag = selected.get(key)
+    fmt = next((f for f in index if f['itag'] == itag), None) if itag is not None else None
+    if fmt is None:
+        fmt = select_format(index, max_kbps) or {'url': resolved['audioUrl']}
+        selected[key] = fmt.get('itag')
+    return fmt
+
+
+def get_audio_url(video_id, base_url=None, max_kbps=None):
+    """Obtém URL de áudio de forma rápida, reaproveitando o cache de streams.
+
+    base_url é a base das URLs do /proxy; obrigatório fora de um contexto de requisição.
+    max_kbps limita o bitrate do formato escolhido no índice de formatos do vídeo.
+    """
+    try:
+        resolved = get_resolved_audio(video_id)
+        fmt = choose_audio_format(resolved, max_kbps)
+
+        # Return a proxied URL so the browser fetches from our server (fixes CORS).
+        proxied = f"{base_url or proxy_base_url()}/proxy?url={urllib.parse.quote_plus(fmt['url'])}&vid={video_id}"
+        result = {k: v for k, v in resolved.items() if k not in ('formats', 'selected')}
+        result['audioUrl'] = proxied
+        if resolved.get('formats'):
+            result['format'] = public_format(fmt)
+            result['formats'] = [public_format(f) for f in resolved['formats']]
+        return result
+
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro ao obter áudio: {e}")
         return {'success': False, 'error': str(e)}
 
+class Prefetcher:
+    """Resolve em segundo plano o áudio das próximas faixas para aquecer o stream_cache.
+
+    Roda em um pool pequeno, com um orçamento global de tarefas pendentes.
+    A prioridade baixa vem da admissão: as extrações rodam como
+    background_work, que nunca espera na fila e deixa vaga para os usuários.
+    Pedidos acima do orçamento, ou com a extração ocupada, são descartados em
+    vez de enfileirados.
+    """
+
+    def __init__(self, count=PREFETCH_COUNT, workers=PREFETCH_WORKERS, max_pending=PREFETCH_MAX_PENDING):
+        self.count = count
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.scheduled = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def schedule(self, video_ids):
+        if not self.enabled:
+            return
+        for video_id in video_ids[:self.count]:
+            if not video_id or stream_cache.contains(video_id):
+                continue
+            with self._lock:
+                if self.pending >= self.max_pending or not extraction_admission.idle_for_background():
+                    self.dropped += 1
+                    continue
+                self.pending += 1
+                self.scheduled += 1
+            self._executor.submit(self._run, video_id)
+
+    def _run(self, video_id):
+        token = background_work.set(True)
+        try:
+            # Sob carga de extração no momento da execução, desiste
+            if not extraction_admission.idle_for_background():
+                with self._lock:
+                    self.dropped += 1
+                return
+            if not stream_cache.contains(video_id):
+                extraction_flight.do(f"stream:{video_id}", resolve_and_cache_audio, video_id)
+            with self._lock:
+                self.completed += 1
+        except Overloaded:
+            # Usuários chegaram antes: a vaga é deles
+            with self._lock:
+                self.dropped += 1
+        except Exception as e:
+            logger.info(f"Pré-busca falhou para {video_id}: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            background_work.reset(token)
+            with self._lock:
+                self.pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'count': self.count,
+                'pending': self.pending,
+                'scheduled': self.scheduled,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+
+# Pré-busca das próximas faixas após /search e /play (ativada com PREFETCH_COUNT)
+prefetcher = Prefetcher()
+
 def format_duration(seconds):
     """Formata duração em segundos para MM:SS"""
     if not seconds:
@@ -433,7 +2829,10 @@ def search():
         logger.info(f"Buscando: {query}")
         results = fast_search(query)
         logger.info(f"Encontrados {len(results)} resultados")
+        prefetcher.schedule([r.get('id') for r in results])
         return jsonify(results)
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro no endpoint /search: {e}")
         return jsonify({'error': 'Falha na busca'}), 500
@@ -445,18 +2844,115 @@ def stream(video_id):
         return '', 200
         
     try:
+        # ?fields=title,duration responde só metadados, do cache/armazém quando possível
+        fields = [f for f in request.args.get('fields', '').split(',') if f]
+        if fields and set(fields) <= set(METADATA_FIELDS):
+            metadata = get_video_metadata(video_id)
+            if metadata is not None:
+                return jsonify(dict({field: metadata.get(field) for field in fields}, success=True, id=video_id))
+
+        quality = request.args.get('quality')
+        max_kbps = request.args.get('maxKbps')
+        if quality is not None and quality not in QUALITY_MAX_KBPS:
+            return jsonify({'error': f"quality deve ser um de: {', '.join(QUALITY_MAX_KBPS)}"}), 400
+        if max_kbps is not None:
+            if not max_kbps.isdigit() or int(max_kbps) <= 0:
+                return jsonify({'error': 'maxKbps deve ser um inteiro positivo'}), 400
+            max_kbps = int(max_kbps)
+        else:
+            max_kbps = QUALITY_MAX_KBPS.get(quality)
+
         logger.info(f"Obtendo stream para: {video_id}")
-        stream_info = get_audio_url(video_id)
+        stream_info = get_audio_url(video_id, max_kbps=max_kbps)
         
         if stream_info['success']:
+            if fields:
+                return jsonify(dict({field: stream_info.get(field) for field in fields}, success=True, id=video_id))
             return jsonify(stream_info)
         else:
             return jsonify({'error': stream_info.get('error', 'Stream não encontrado')}), 404
             
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro no endpoint /stream: {e}")
         return jsonify({'error': 'Falha ao obter stream'}), 500
 
+# Pool limitado compartilhado por todas as requisições de /stream/batch
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+def resolve_batch_item(video_id, base_url):
+    try:
+        result = get_audio_url(video_id, base_url=base_url)
+    except Overloaded as e:
+        result = {'success': False, 'error': str(e), 'retryAfter': e.retry_after}
+    return dict(result, id=video_id)
+
+@app.route('/stream/batch', methods=['POST', 'OPTIONS'])
+def stream_batch():
+    """Resolve vários vídeos em paralelo; com ?stream=1 responde NDJSON conforme terminam"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    payload = request.get_json(silent=True)
+    ids = payload.get('ids') if isinstance(payload, dict) else payload
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i for i in ids):
+        return jsonify({'error': 'Envie {"ids": ["video_id", ...]}'}), 400
+    if len(ids) > BATCH_MAX_IDS:
+        return jsonify({'error': f'Máximo de {BATCH_MAX_IDS} IDs por lote'}), 400
+
+    logger.info(f"Resolvendo lote de {len(ids)} streams")
+    base_url = proxy_base_url()
+    futures = [batch_executor.submit(contextvars.copy_context().run, resolve_batch_item, video_id, base_url)
+               for video_id in ids]
+
+    wants_ndjson = request.args.get('stream') in ('1', 'true') or 'application/x-ndjson' in request.headers.get('Accept', '')
+    if not wants_ndjson:
+        return jsonify({'results': [f.result() for f in futures]})
+
+    def generate():
+        for future in as_completed(futures):
+            yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), content_type='application/x-ndjson')
+
+@app.route('/playlist/<playlist_id>', methods=['GET', 'OPTIONS'])
+def playlist(playlist_id):
+    """Entradas de uma playlist com offset/limit; com ?stream=1 responde NDJSON"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', PLAYLIST_PAGE_SIZE)), 1), PLAYLIST_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'offset e limit devem ser inteiros'}), 400
+
+    wants_ndjson = request.args.get('stream') in ('1', 'true') or 'application/x-ndjson' in request.headers.get('Accept', '')
+    try:
+        if not wants_ndjson:
+            return jsonify(playlist_page(playlist_id, offset, limit))
+
+        cursor = get_playlist_cursor(playlist_id)
+
+        def generate():
+            try:
+                for entry in cursor.iter_entries(offset, limit):
+                    yield json.dumps(entry, ensure_ascii=False) + '\n'
+            except Overloaded as e:
+                yield json.dumps({'error': str(e), 'retryAfter': e.retry_after}) + '\n'
+            except Exception as e:
+                logger.error(f"Erro ao ler playlist {playlist_id}: {e}")
+                drop_playlist_cursor(playlist_id)
+                yield json.dumps({'error': 'Falha ao ler playlist'}) + '\n'
+
+        return Response(stream_with_context(generate()), content_type='application/x-ndjson')
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Erro no endpoint /playlist: {e}")
+        return jsonify({'error': 'Falha ao obter playlist'}), 500
+
 @app.route('/play', methods=['GET'])
 def play_direct():
     """Endpoint direto para tocar música"""
@@ -476,6 +2972,7 @@ def play_direct():
         
         # Obtém o stream
         stream_info = get_audio_url(video['id'])
+        prefetcher.schedule([r.get('id') for r in results[1:]])
         
         if stream_info['success']:
             response_data = {
@@ -486,6 +2983,8 @@ def play_direct():
         else:
             return jsonify({'error': 'Falha ao obter áudio'}), 500
             
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Erro no play direto: {e}")
         return jsonify({'error': str(e)}), 500
@@ -496,9 +2995,75 @@ def health():
     return jsonify({
         'status': 'online', 
         'service': 'YT Proxy Python Fast',
-        'timestamp': logging.getLoggerClass().root.handlers[0].baseFilename
+        'timestamp': time.time()
+    })
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Prontidão: 200 só depois do aquecimento dos extratores, senão 503"""
+    state = warmup.stats()
+    return jsonify(state), 200 if state['ready'] else 503
+
+@metrics.collector
+def collect_runtime_metrics():
+    """Métricas lidas dos contadores já mantidos pelos caches e pools"""
+    caches = {
+        'stream': stream_cache.stats(),
+        'search': search_cache.stats(),
+        'manifest': manifest_cache.stats(),
+        'proxy_disk': proxy_cache.stats(),
+    }
+    cache_samples = []
+    for name, st in caches.items():
+        cache_samples.append(((('cache', name), ('result', 'hit')), st['hits']))
+        cache_samples.append(((('cache', name), ('result', 'miss')), st['misses']))
+    flight = extraction_flight.stats()
+    return [
+        ('ytproxy_cache_requests_total', 'counter', 'Consultas aos caches por resultado', cache_samples),
+        ('ytproxy_inflight_requests', 'gauge', 'Requisições HTTP em andamento', [((), inflight_requests)]),
+        ('ytproxy_inflight_extractions', 'gauge', 'Extrações em andamento (single-flight)', [((), flight['inFlight'])]),
+        ('ytproxy_shared_extractions_total', 'counter', 'Requisições que aproveitaram extração em andamento',
+         [((), flight['shared'])]),
+        ('ytproxy_extraction_queue_depth', 'gauge', 'Chamadas aguardando vaga de extração',
+         [((), extraction_admission.waiting)]),
+        ('ytproxy_extraction_active', 'gauge', 'Extrações ocupando vaga', [((), extraction_admission.active)]),
+        ('ytproxy_proxy_cache_bytes', 'gauge', 'Bytes no cache em disco do /proxy', [((), caches['proxy_disk']['bytesUsed'])]),
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas no formato de texto do Prometheus"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Estatísticas internas (caches)"""
+    return jsonify({
+        'streamCache': stream_cache.stats(),
+        'searchCache': search_cache.stats(),
+        'extractionFlight': extraction_flight.stats(),
+        'resolver': audio_resolver.stats(),
+        'prefetch': prefetcher.stats(),
+        'ydlPools': {name: pool.stats() for name, pool in ydl_pools.items()},
+        'extractionPool': extraction_pool.stats(),
+        'admission': extraction_admission.stats(),
+        'rateLimit': rate_limiter.stats(),
+        'upstreamHttp': upstream.stats(),
+        'proxyCache': proxy_cache.stats(),
+        'metadataStore': metadata_store.stats(),
+        'sharedCache': shared_cache.stats(),
+        'pid': os.getpid(),
+        'transcode': dict(transcode_cache.stats(), active=transcode_active, maxProcs=TRANSCODE_MAX_PROCS),
+        'manifestCache': manifest_cache.stats(),
+        'segmentReadahead': segment_readahead.stats(),
+        'asyncProxy': async_proxy.stats()
     })
 
+@app.route('/invidious/stats', methods=['GET'])
+def invidious_stats():
+    """Placar das instâncias Invidious"""
+    return jsonify({'instances': invidious.stats(), 'order': invidious.ordered()})
+
 @app.route('/')
 def index():
     """Página inicial"""
@@ -518,8 +3083,13 @@ def index():
         
         <div class="endpoint"><strong>GET /search?q=query</strong> - Buscar vídeos</div>
         <div class="endpoint"><strong>GET /stream/video_id</strong> - Obter áudio</div>
+        <div class="endpoint"><strong>POST /stream/batch</strong> - Obter áudio de vários vídeos (?stream=1 para NDJSON)</div>
+        <div class="endpoint"><strong>GET /playlist/playlist_id?offset=0&limit=50</strong> - Páginas de playlist (?stream=1 para NDJSON)</div>
         <div class="endpoint"><strong>GET /play?q=query</strong> - Buscar e tocar direto</div>
         <div class="endpoint"><strong>GET /health</strong> - Status do servidor</div>
+        <div class="endpoint"><strong>GET /stats</strong> - Estatísticas internas</div>
+        <div class="endpoint"><strong>GET /metrics</strong> - Métricas Prometheus</div>
+        <div class="endpoint"><strong>GET /invidious/stats</strong> - Saúde das instâncias Invidious</div>
         
         <p><a href="/player" style="color: #ff0000;">➡️ Ir para o Player</a></p>
     </body>
@@ -533,12 +3103,354 @@ def player_page():
     return send_file('index.html')
 
 
+def parse_range_header(value):
+    """Interpreta um header Range de intervalo único.
+
+    Retorna (start, end) com end None para intervalos abertos ("bytes=500-"),
+    ou (None, n) para sufixos ("bytes=-n"). Retorna None se ausente ou inválido.
+    """
+    if not value:
+        return None
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', value)
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    start = int(match.group(1)) if match.group(1) else None
+    end = int(match.group(2)) if match.group(2) else None
+    if start is not None and end is not None and end < start:
+        return None
+    return start, end
+
+def parse_content_range(value):
+    """Interpreta "bytes a-b/total" em (a, b, total); total None quando "*" """
+    match = re.fullmatch(r'\s*bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)\s*', value or '')
+    if not match:
+        return None, None, None
+    start = int(match.group(1)) if match.group(1) else None
+    end = int(match.group(2)) if match.group(2) else None
+    total = int(match.group(3)) if match.group(3) != '*' else None
+    return start, end, total
+
+def is_manifest(target, content_type=''):
+    return 'vnd.apple.mpegurl' in content_type or target.lower().endswith('.m3u8')
+
+def fetch_range(target, headers, start, end):
+    """Busca um intervalo de bytes no upstream"""
+    range_value = f"bytes={start}-{end}" if start is not None else f"bytes=-{end}"
+    return upstream.get(target, headers=dict(headers, Range=range_value), stream=True)
+
+def first_window(target, headers, client_range):
+    """Primeira busca limitada a PROXY_RANGE_CHUNK bytes para o intervalo pedido.
+
+    Sufixos maiores que uma janela são convertidos em intervalo absoluto
+    com uma sonda de 1 byte para descobrir o tamanho total.
+    """
+    start, end = client_range if client_range else (0, None)
+    if start is None:
+        if end <= PROXY_RANGE_CHUNK:
+            return fetch_range(target, headers, None, end), client_range
+        probe = fetch_range(target, headers, 0, 0)
+        total = parse_content_range(probe.headers.get('Content-Range'))[2]
+        if probe.status_code != 206 or total is None:
+            return probe, client_range
+        probe.close()
+        start, end = max(total - end, 0), total - 1
+        client_range = (start, end)
+    window_end = start + PROXY_RANGE_CHUNK - 1
+    if end is not None:
+        window_end = min(window_end, end)
+    return fetch_range(target, headers, start, window_end), client_range
+
+def proxy_cache_key(target, video_id=None):
+    """Identidade estável do recurso: vídeo + itag + tamanho, não a URL assinada.
+
+    Só URLs de hosts em PROXY_CACHE_HOSTS com itag= e clen= são cacheáveis.
+    """
+    parts = urllib.parse.urlsplit(target)
+    host = (parts.hostname or '').lower()
+    if not any(host == h or host.endswith('.' + h) for h in PROXY_CACHE_HOSTS):
+        return None, None
+    params = urllib.parse.parse_qs(parts.query)
+    itag = params.get('itag', [None])[0]
+    clen = params.get('clen', [None])[0]
+    video_id = video_id or params.get('id', [None])[0]
+    if not (video_id and itag and clen and clen.isdigit()):
+        return None, None
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', f"{video_id}-{itag}-{clen}"), int(clen)
+
+def absolute_range(client_range, size):
+    """Converte o intervalo pedido em (start, end) absolutos; None se insatisfatível"""
+    start, end = client_range if client_range else (0, None)
+    if start is None:
+        start, end = max(size - end, 0), size - 1
+    elif end is None or end >= size:
+        end = size - 1
+    if start >= size or size == 0:
+        return None
+    return start, end
+
+def serve_from_cache(entry, start, end, range_header):
+    """Serve bytes em disco: arquivo completo via send_file, intervalos via mmap"""
+    content_type = entry['contentType'] or 'application/octet-stream'
+    if entry['ranges'] == [[0, entry['size']]]:
+        # werkzeug trata Range/206 e usa wsgi.file_wrapper (sendfile no servidor)
+        return send_file(entry['path'], mimetype=content_type, conditional=True, etag=False)
+
+    def generate():
+        with open(entry['path'], 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos in range(start, end + 1, 64 * 1024):
+                yield mm[pos:min(pos + 64 * 1024, end + 1)]
+
+    resp = Response(generate(), status=206 if range_header else 200, content_type=content_type)
+    if range_header:
+        resp.headers['Content-Range'] = f"bytes {start}-{end}/{entry['size']}"
+    resp.headers['Content-Length'] = str(end - start + 1)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    return resp
+
+def proxy_request_headers(client_headers):
+    """Headers repassados ao upstream (User-Agent ajuda alguns endpoints)"""
+    headers = {
+        'User-Agent': client_headers.get('User-Agent', 'yt-proxy/1.0'),
+        'Accept-Encoding': 'identity',
+    }
+    if client_headers.get('If-Range'):
+        headers['If-Range'] = client_headers['If-Range']
+    return headers
+
+MANIFEST_URI_ATTR = re.compile(r'URI="([^"]*)"')
+
+def proxied_media_url(url, target):
+    """URL absoluta (relativa ao manifesto) reescrita para o /proxy; outros esquemas ficam como estão"""
+    abs_url = urllib.parse.urljoin(target, url)
+    if not abs_url.startswith('http://') and not abs_url.startswith('https://'):
+        return url, None
+    return f"/proxy?url={urllib.parse.quote_plus(abs_url)}", abs_url
+
+
+class ManifestRewrite:
+    """Reescreve um manifesto m3u8 linha a linha para passar pelo /proxy.
+
+    Reescreve as linhas de mídia e os atributos URI="..." das tags
+    (#EXT-X-KEY, #EXT-X-MAP, #EXT-X-MEDIA...). Ao terminar, guarda o
+    manifesto no manifest_cache e registra os segmentos para leitura adiante.
+    Só contam como segmento as URIs após #EXTINF; as variantes de um master
+    playlist (#EXT-X-STREAM-INF) são manifestos e nunca vão para o cache de bytes.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.lines = []
+        self.segments = []
+        self.is_vod = False
+        self._after_extinf = False
+
+    def feed(self, line):
+        line = line.rstrip('\r\n')
+        if line.startswith('#'):
+            if line.startswith('#EXT-X-ENDLIST') or line.startswith('#EXT-X-PLAYLIST-TYPE:VOD'):
+                self.is_vod = True
+            if line.startswith('#EXTINF'):
+                self._after_extinf = True
+            if 'URI="' in line:
+                line = MANIFEST_URI_ATTR.sub(lambda m: f'URI="{proxied_media_url(m.group(1), self.target)[0]}"', line)
+        elif line.strip():
+            line, abs_url = proxied_media_url(line.strip(), self.target)
+            if abs_url and self._after_extinf and not is_manifest(abs_url):
+                self.segments.append(abs_url)
+            self._after_extinf = False
+        self.lines.append(line)
+        return line
+
+    def finish(self):
+        body = '\n'.join(self.lines)
+        manifest_cache.set(self.target, body, ttl=MANIFEST_VOD_TTL if self.is_vod else MANIFEST_LIVE_TTL)
+        segment_readahead.register(self.segments, ttl=MANIFEST_VOD_TTL if self.is_vod else MANIFEST_LIVE_TTL * 30)
+        return body
+
+
+def stream_manifest(r, target):
+    """Gera o manifesto reescrito conforme as linhas chegam do upstream"""
+    rewrite = ManifestRewrite(target)
+    try:
+        first = True
+        for raw in r.iter_lines():
+            line = rewrite.feed(raw.decode(r.encoding or 'utf-8', errors='replace'))
+            yield line if first else '\n' + line
+            first = False
+        rewrite.finish()
+    finally:
+        r.close()
+
+def segment_cache_key(url):
+    """Segmentos HLS não têm vídeo/itag na query: a chave é o hash da URL do segmento"""
+    return 'seg-' + hashlib.sha1(url.encode()).hexdigest()[:32]
+
+def proxy_cache_identity(target, video_id=None):
+    """Chave e tamanho no cache em disco: mídia do googlevideo ou segmento de manifesto"""
+    cache_key, cache_size = proxy_cache_key(target, video_id)
+    if cache_key is None and segment_readahead.is_segment(target):
+        cache_key = segment_cache_key(target)
+        cache_size = proxy_cache.size(cache_key)
+    return cache_key, cache_size
+
+def response_size(status, headers):
+    """Tamanho total do recurso segundo a resposta do upstream"""
+    if status == 206:
+        return parse_content_range(headers.get('Content-Range'))[2]
+    if status == 200 and str(headers.get('Content-Length', '')).isdigit():
+        return int(headers['Content-Length'])
+    return None
+
+
+class SegmentReadahead:
+    """Lê adiante os próximos segmentos de um manifesto para o cache em disco.
+
+    Quando o /proxy serve o segmento i, busca os segmentos i+1..i+count em
+    segundo plano, para o player não esperar uma ida ao upstream por segmento.
+    """
+
+    def __init__(self, count=SEGMENT_READAHEAD, workers=SEGMENT_READAHEAD_WORKERS):
+        self.count = count
+        self._index = TTLCache(50000, MANIFEST_VOD_TTL)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='readahead')
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self.fetched = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return self.count > 0 and proxy_cache.enabled
+
+    def register(self, segments, ttl):
+        if not self.enabled:
+            return
+        segments = tuple(segments)
+        for i, url in enumerate(segments):
+            self._index.set(url, (segments, i), ttl=ttl)
+
+    def is_segment(self, url):
+        return self.enabled and self._index.contains(url)
+
+    def after_serve(self, url):
+        """Agenda a leitura dos segmentos seguintes ao que acabou de ser pedido"""
+        if not self.is_segment(url):
+            return
+        found = self._index.get(url)
+        if not found:
+            return
+        segments, index = found
+        for next_url in segments[index + 1:index + 1 + self.count]:
+            key = segment_cache_key(next_url)
+            with self._lock:
+                if key in self._inflight or proxy_cache.is_complete(key):
+                    continue
+                self._inflight.add(key)
+            self._executor.submit(self._fetch, next_url, key)
+
+    def _fetch(self, url, key):
+        try:
+            r = upstream.get(url, headers={'Accept-Encoding': 'identity'}, stream=True)
+            try:
+                size = response_size(r.status_code, r.headers)
+                if r.status_code != 200 or not size:
+                    raise RuntimeError(f"HTTP {r.status_code}")
+                if is_manifest(url, r.headers.get('Content-Type', '')):
+                    # Manifesto servido do disco sairia sem a reescrita para o /proxy
+                    raise RuntimeError('manifesto, não segmento')
+                fill = proxy_cache.open_fill(key, size, r.headers.get('Content-Type', ''))
+                offset = 0
+                try:
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        fill.write(offset, chunk)
+                        offset += len(chunk)
+                finally:
+                    fill.close()
+            finally:
+                r.close()
+            with self._lock:
+                self.fetched += 1
+        except Exception as e:
+            logger.info(f"Leitura adiante falhou para {url}: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'count': self.count,
+                'inFlight': len(self._inflight),
+                'fetched': self.fetched,
+                'failed': self.failed,
+            }
+
+
+# Manifestos reescritos (TTL curto para live) e leitura adiante de segmentos
+manifest_cache = TTLCache(MANIFEST_CACHE_MAX_ENTRIES, MANIFEST_LIVE_TTL)
+segment_readahead = SegmentReadahead()
+
+def plan_proxy_response(status, upstream_headers, client_range, range_header, cache_key=None, cache_size=None):
+    """Decide status e headers da resposta a partir da primeira resposta do upstream.
+
+    Retorna (status, headers, next_pos, end, write_pos): next_pos/end delimitam as
+    janelas que ainda faltam buscar e write_pos é o offset do primeiro byte para o
+    cache em disco (None quando o corpo não é cacheável).
+    """
+    extra_headers = {}
+    next_pos = end = None
+    upstream_status = status
+    if status == 206 and (client_range is not None or not range_header):
+        first_start, first_end, total = parse_content_range(upstream_headers.get('Content-Range'))
+        if first_start is not None and total is not None:
+            start = first_start
+            end = total - 1
+            if client_range and client_range[0] is not None and client_range[1] is not None:
+                end = min(client_range[1], total - 1)
+            next_pos = first_end + 1
+            if range_header:
+                extra_headers['Content-Range'] = f"bytes {start}-{end}/{total}"
+            else:
+                # The client asked for the whole resource: answer 200 as before
+                status = 200
+            extra_headers['Content-Length'] = str(end - start + 1)
+            extra_headers['Accept-Ranges'] = 'bytes'
+    if not extra_headers:
+        # Pass through as-is (200 full body, 416, multi-range, errors)
+        for name in ('Content-Length', 'Content-Range', 'Accept-Ranges'):
+            if upstream_headers.get(name):
+                extra_headers[name] = upstream_headers[name]
+
+    write_pos = None
+    if cache_key and upstream_status == 206:
+        first_start, _, total = parse_content_range(upstream_headers.get('Content-Range'))
+        if total == cache_size:
+            write_pos = first_start
+    elif cache_key and upstream_status == 200 and upstream_headers.get('Content-Length') == str(cache_size):
+        write_pos = 0
+    return status, extra_headers, next_pos, end, write_pos
+
+def range_windows(next_pos, end):
+    """Janelas (start, end) de no máximo PROXY_RANGE_CHUNK bytes ainda a buscar"""
+    pos = next_pos
+    while pos is not None and pos <= end:
+        window_end = min(pos + PROXY_RANGE_CHUNK - 1, end)
+        yield pos, window_end
+        pos = window_end + 1
+
 @app.route('/proxy')
+@metered('sync')
 def proxy():
     """Proxy generic to fetch remote media/manifests and return them with CORS headers.
 
     If the proxied resource is an M3U8 manifest, rewrite any media/segment URLs to point
     back to this proxy so the browser doesn't request googlevideo directly (avoids CORS).
+
+    Range/If-Range are forwarded and 206 responses passed through; large requests are
+    split into upstream range fetches of at most PROXY_RANGE_CHUNK bytes.
     """
     target = request.args.get('url', '')
     if not target:
@@ -548,10 +3460,34 @@ def proxy():
     if not target.startswith('http://') and not target.startswith('https://'):
         return jsonify({'error': 'invalid url'}), 400
 
+    headers = proxy_request_headers(request.headers)
+    range_header = request.headers.get('Range')
+    client_range = parse_range_header(range_header)
+
+    if manifest_cache.contains(target):
+        body = manifest_cache.get(target)
+        if body is not None:
+            return Response(body, content_type='application/vnd.apple.mpegurl')
+
+    cache_key, cache_size = proxy_cache_identity(target, request.args.get('vid'))
+    segment_readahead.after_serve(target)
+    if cache_key and cache_size and proxy_cache.enabled and (client_range or not range_header) and not request.headers.get('If-Range'):
+        wanted = absolute_range(client_range, cache_size)
+        entry = proxy_cache.lookup(cache_key, *wanted) if wanted else None
+        if entry:
+            return serve_from_cache(entry, wanted[0], wanted[1], range_header)
+
     try:
-        # Forward select headers (User-Agent helps some endpoints)
-        headers = {'User-Agent': request.headers.get('User-Agent', 'yt-proxy/1.0')}
-        r = requests.get(target, headers=headers, stream=True, timeout=15)
+        if is_manifest(target):
+            r = upstream.get(target, headers=headers, stream=True)
+        elif range_header and client_range is None:
+            # Multi-range or unknown syntax: forward unchanged, without splitting
+            r = upstream.get(target, headers=dict(headers, Range=range_header), stream=True)
+        else:
+            r, client_range = first_window(target, headers, client_range)
+            if r.status_code == 206 and is_manifest(target, r.headers.get('Content-Type', '')):
+                r.close()
+                r = upstream.get(target, headers=headers, stream=True)
     except Exception as e:
         logger.error(f"Proxy fetch error for {target}: {e}")
         return jsonify({'error': 'failed to fetch target'}), 502
@@ -560,60 +3496,798 @@ def proxy():
     content_type = r.headers.get('Content-Type', '')
 
     # If it's an HLS manifest (m3u8), rewrite URLs inside
-    if 'application/vnd.apple.mpegurl' in content_type or target.endswith('.m3u8') or 'vnd.apple.mpegurl' in content_type or target.lower().endswith('.m3u8'):
-        try:
-            text = r.text
-            lines = text.splitlines()
-            out_lines = []
-            base = target.rsplit('/', 1)[0]
-            for line in lines:
-                if not line or line.startswith('#'):
-                    out_lines.append(line)
-                    continue
-
-                # If line is a relative path, make absolute
-                if not line.startswith('http://') and not line.startswith('https://'):
-                    abs_url = urllib.parse.urljoin(base + '/', line)
-                else:
-                    abs_url = line
-
-                # Replace with proxied URL
-                prox = f"/proxy?url={urllib.parse.quote_plus(abs_url)}"
-                out_lines.append(prox)
+    if is_manifest(target, content_type):
+        if r.status_code != 200:
+            r.close()
+            return jsonify({'error': 'failed to fetch manifest'}), 502
+        # Rewritten line by line as it arrives; after_request sets the CORS headers
+        return Response(stream_with_context(stream_manifest(r, target)), content_type='application/vnd.apple.mpegurl')
 
-            body = '\n'.join(out_lines)
-            resp = Response(body, content_type='application/vnd.apple.mpegurl')
-            # after_request will set the proper CORS header; don't add here to avoid duplicates
-            return resp
-        except Exception as e:
-            logger.error(f"Error processing m3u8 from {target}: {e}")
-            return jsonify({'error': 'failed to process manifest'}), 500
+    if cache_key and not cache_size:
+        cache_size = response_size(r.status_code, r.headers)
+    status, extra_headers, next_pos, end, write_pos = plan_proxy_response(
+        r.status_code, r.headers, client_range, range_header, cache_key, cache_size)
+    fill = proxy_cache.open_fill(cache_key if write_pos is not None else None, cache_size, content_type)
 
     # For other resources (segments, mp4, etc.) stream bytes back
     def generate():
+        offset = write_pos
         try:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    yield chunk
+            try:
+                for chunk in r.iter_content(chunk_size=8192):
+                    if chunk:
+                        if offset is not None:
+                            fill.write(offset, chunk)
+                            offset += len(chunk)
+                        yield chunk
+            finally:
+                r.close()
+
+            for pos, window_end in range_windows(next_pos, end):
+                sub = fetch_range(target, headers, pos, window_end)
+                try:
+                    if sub.status_code != 206 or parse_content_range(sub.headers.get('Content-Range'))[0] != pos:
+                        logger.error(f"Proxy range fetch {pos}-{window_end} for {target} returned {sub.status_code}")
+                        return
+                    offset = pos if offset is not None else None
+                    for chunk in sub.iter_content(chunk_size=8192):
+                        if chunk:
+                            if offset is not None:
+                                fill.write(offset, chunk)
+                                offset += len(chunk)
+                            yield chunk
+                finally:
+                    sub.close()
         finally:
-            r.close()
+            fill.close()
 
-    resp = Response(stream_with_context(generate()), content_type=content_type)
-    # Mirror length if available
-    if r.headers.get('Content-Length'):
-        resp.headers['Content-Length'] = r.headers.get('Content-Length')
+    resp = Response(stream_with_context(generate()), status=status, content_type=content_type)
+    for name, value in extra_headers.items():
+        resp.headers[name] = value
     # after_request will set Access-Control-Allow-Origin
     return resp
 
+# Formatos do /transcode: codec do ffmpeg, muxer e Content-Type
+TRANSCODE_FORMATS = {
+    'mp3': ('libmp3lame', 'mp3', 'audio/mpeg'),
+    'opus': ('libopus', 'ogg', 'audio/ogg'),
+    'aac': ('aac', 'adts', 'audio/aac'),
+}
+TRANSCODE_BITRATES = (32, 48, 64, 96, 128, 160, 192, 256, 320)
+
+
+class FileCache:
+    """Diretório de arquivos completos limitado em bytes, com remoção LRU pelo último acesso"""
+
+    # Temporários (.part) sem escrita há mais que isso são sobras de um processo morto
+    STALE_PART_AGE = 3600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                # Outros processos (extração, workers) importam este módulo: só
+                # remove temporários abandonados, nunca os de um encode em curso
+                try:
+                    if time.time() - os.path.getmtime(path) > self.STALE_PART_AGE:
+                        os.remove(path)
+                except OSError:
+                    pass
+            elif os.path.isfile(path):
+                files.append((os.path.getatime(path), name, os.path.getsize(path)))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.bytes_used += size
+
+    def partition(self, index, count):
+        """Modo prefork: usa o subdiretório worker-<index> com 1/count do orçamento.
+
+        Cada worker tem seu próprio índice em memória; dividir o diretório evita
+        que um remova arquivos que outro ainda considera em cache.
+        """
+        self.directory = os.path.join(self.directory, f"worker-{index}")
+        self.max_bytes //= max(count, 1)
+        self._entries = OrderedDict()
+        self.bytes_used = 0
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def get(self, name):
+        """Caminho do arquivo em cache, ou None"""
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+        return os.path.join(self.directory, name)
+
+    def temp_path(self, name):
+        return os.path.join(self.directory, f"{name}.{os.getpid()}.{threading.get_ident()}.part")
+
+    def commit(self, name, temp_path):
+        """Publica um arquivo terminado e remove os mais antigos acima do limite"""
+        size = os.path.getsize(temp_path)
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, os.path.join(self.directory, name))
+        with self._lock:
+            self.bytes_used += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            while self.bytes_used > self.max_bytes and len(self._entries) > 1:
+                old, old_size = self._entries.popitem(last=False)
+                self.bytes_used -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytesUsed': self.bytes_used,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+transcode_cache = FileCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_MAX_BYTES)
+transcode_slots = threading.BoundedSemaphore(max(TRANSCODE_MAX_PROCS, 1))
+transcode_active = 0
+transcode_lock = threading.Lock()
+
+
+def feed_ffmpeg(process, target, headers):
+    """Copia o áudio do upstream para o stdin do ffmpeg em janelas de PROXY_RANGE_CHUNK"""
+    pos = 0
+    total = None
+    try:
+        while total is None or pos < total:
+            r = fetch_range(target, headers, pos, pos + PROXY_RANGE_CHUNK - 1)
+            try:
+                if r.status_code == 200:
+                    total = pos = 0
+                elif r.status_code != 206:
+                    logger.error(f"Transcode: upstream respondeu {r.status_code} para {target}")
+                    return
+                else:
+                    total = parse_content_range(r.headers.get('Content-Range'))[2]
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    if chunk:
+                        process.stdin.write(chunk)
+                        pos += len(chunk)
+            finally:
+                r.close()
+            if r.status_code == 200 or total is None:
+                return
+    except (BrokenPipeError, ValueError, OSError):
+        # ffmpeg encerrado (cliente desconectou ou erro de decodificação)
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+@app.route('/transcode/<video_id>', methods=['GET', 'OPTIONS'])
+def transcode(video_id):
+    """Áudio recodificado pelo ffmpeg (?fmt=mp3|opus|aac&br=96), enviado enquanto é gerado.
+
+    Saídas completas ficam no transcode_cache; repetições são servidas do disco
+    com suporte a Range.
+    """
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    fmt = request.args.get('fmt', 'mp3').lower()
+    if fmt not in TRANSCODE_FORMATS:
+        return jsonify({'error': f"fmt deve ser um de: {', '.join(TRANSCODE_FORMATS)}"}), 400
+    try:
+        bitrate = int(request.args.get('br', '128'))
+    except ValueError:
+        bitrate = 0
+    if bitrate not in TRANSCODE_BITRATES:
+        return jsonify({'error': f"br deve ser um de: {', '.join(map(str, TRANSCODE_BITRATES))}"}), 400
+    codec, container, content_type = TRANSCODE_FORMATS[fmt]
+    name = f"{video_id}-{bitrate}k.{fmt}"
+
+    cached = transcode_cache.get(name) if transcode_cache.enabled else None
+    if cached:
+        response = send_file(cached, mimetype=content_type, conditional=True, etag=False)
+        response.headers['X-Transcode-Cache'] = 'hit'
+        return response
+
+    if shutil.which(FFMPEG_PATH) is None:
+        return jsonify({'error': 'ffmpeg não disponível no servidor'}), 501
+    if request.method == 'HEAD':
+        # Sem corpo não há o que transcodificar; não ocupa vaga nem sobe o ffmpeg
+        response = Response(content_type=content_type)
+        response.headers['X-Transcode-Cache'] = 'miss'
+        return response
+
+    try:
+        resolved = get_resolved_audio(video_id)
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao resolver áudio para transcode {video_id}: {e}")
+        return jsonify({'error': 'Stream não encontrado'}), 404
+
+    if not transcode_slots.acquire(blocking=False):
+        raise Overloaded('Limite de transcodificações simultâneas atingido', 5)
+    try:
+        command = [FFMPEG_PATH, '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                   '-vn', '-map_metadata', '-1', '-c:a', codec, '-b:a', f"{bitrate}k", '-f', container, 'pipe:1']
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except BaseException:
+        transcode_slots.release()
+        raise
+
+    logger.info(f"Transcodificando {video_id} para {fmt} {bitrate}k")
+    feeder = threading.Thread(target=feed_ffmpeg, name='transcode-feed', daemon=True,
+                              args=(process, resolved['audioUrl'], proxy_request_headers(request.headers)))
+    feeder.start()
+    global transcode_active
+    with transcode_lock:
+        transcode_active += 1
+    released = threading.Event()
+
+    def release():
+        """Encerra o ffmpeg e devolve a vaga; roda uma vez, no fim do corpo ou no close da resposta"""
+        global transcode_active
+        with transcode_lock:
+            if released.is_set():
+                return
+            released.set()
+            transcode_active -= 1
+        try:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            feeder.join(timeout=5)
+        finally:
+            transcode_slots.release()
+
+    def generate():
+        temp_path = transcode_cache.temp_path(name) if transcode_cache.enabled else None
+        out = None
+        complete = False
+        try:
+            out = open(temp_path, 'wb') if temp_path else None
+            while True:
+                chunk = process.stdout.read1(64 * 1024)
+                if not chunk:
+                    break
+                if out:
+                    out.write(chunk)
+                yield chunk
+            complete = process.wait() == 0
+        finally:
+            release()
+            if out:
+                out.close()
+                try:
+                    if complete:
+                        transcode_cache.commit(name, temp_path)
+                    else:
+                        os.remove(temp_path)
+                except OSError as e:
+                    logger.warning(f"Temporário do transcode {name} indisponível: {e}")
+
+    response = Response(stream_with_context(generate()), content_type=content_type)
+    # Se o corpo nunca for iterado (cliente caiu antes do primeiro byte), o finally
+    # do gerador não roda; o close da resposta devolve a vaga mesmo assim
+    response.call_on_close(release)
+    response.headers['X-Transcode-Cache'] = 'miss'
+    return response
+
+
+class DiskCacheWriter:
+    """Thread que grava o cache em disco do motor assíncrono fora do event loop.
+
+    As operações de cada stream (abrir, gravar, fechar) entram numa fila FIFO
+    única, então chegam ao CacheFill na ordem certa. Com mais de max_pending
+    bytes esperando (disco lento), os pedaços novos são descartados: viram um
+    buraco nos intervalos gravados, nunca atraso para o cliente.
+    """
+
+    def __init__(self, max_pending=64 * 1024 * 1024):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn, *args, size=0):
+        with self._lock:
+            if size and self.pending + size > self.max_pending:
+                self.dropped += size
+                return
+            self.pending += size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='async-proxy-disk', daemon=True)
+                self._thread.start()
+        self._queue.put((fn, args, size))
+
+    def _loop(self):
+        while True:
+            fn, args, size = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.warning(f"Falha na gravação do cache em disco: {e}")
+            finally:
+                with self._lock:
+                    self.pending -= size
+
+    def open_fill(self, key, size, content_type):
+        return AsyncCacheFill(self, key, size, content_type)
+
+
+class AsyncCacheFill:
+    """CacheFill cujas operações rodam na thread do DiskCacheWriter"""
+
+    def __init__(self, writer, key, size, content_type):
+        self.writer = writer
+        self.fill = None
+        if key and proxy_cache.enabled:
+            writer.submit(self._open, key, size, content_type)
+
+    def _open(self, key, size, content_type):
+        self.fill = proxy_cache.open_fill(key, size, content_type)
+
+    def _write(self, offset, data):
+        if self.fill is not None:
+            self.fill.write(offset, data)
+
+    def _close(self):
+        if self.fill is not None:
+            self.fill.close()
+
+    def write(self, offset, data):
+        self.writer.submit(self._write, offset, data, size=len(data))
+
+    def close(self):
+        self.writer.submit(self._close)
+
+
+def read_cached(path, start, size):
+    """Lê um trecho de um arquivo do cache (roda no executor, fora do event loop)"""
+    with open(path, 'rb') as fh:
+        return os.pread(fh.fileno(), size, start)
+
+
+class AsyncProxyEngine:
+    """Motor asyncio (aiohttp) para o /proxy, rodando em thread própria.
+
+    Cada stream é uma tarefa leve no event loop em vez de uma thread do Flask.
+    A leitura do upstream alimenta uma fila limitada (buffer_bytes por conexão)
+    e só continua quando o cliente consome: se o cliente fica lento, a fila
+    enche e paramos de ler o upstream (backpressure via TCP). O acesso ao
+    cache em disco nunca roda no loop: gravações vão para o DiskCacheWriter e
+    leituras para o executor.
+    """
+
+    def __init__(self, port=ASYNC_PROXY_PORT, buffer_bytes=ASYNC_PROXY_BUFFER, chunk_size=ASYNC_PROXY_CHUNK):
+        self.port = port
+        # No modo prefork cada worker abre a mesma porta e o kernel distribui as conexões
+        self.reuse_port = False
+        self.buffer_bytes = buffer_bytes
+        self.chunk_size = chunk_size
+        self.running = False
+        self.active_streams = 0
+        self.total_streams = 0
+        self.bytes_sent = 0
+        self._disk = DiskCacheWriter()
+        self._loop = None
+        self._session = None
+
+    def start(self, host='0.0.0.0'):
+        if not self.port:
+            return False
+        if not aiohttp.available():
+            logger.warning("aiohttp não instalado; motor assíncrono do /proxy desativado")
+            return False
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(host, ready), name='async-proxy', daemon=True).start()
+        ready.wait()
+        return self.running
+
+    def _run(self, host, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve(host))
+            self.running = True
+            logger.info(f"Motor assíncrono do /proxy em http://{host}:{self.port}")
+        except Exception as e:
+            logger.error(f"Falha ao iniciar motor assíncrono do /proxy: {e}")
+        finally:
+            ready.set()
+        if self.running:
+            self._loop.run_forever()
+
+    async def _serve(self, host):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_POOL_MAXSIZE, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+        aio_app = web.Application()
+        aio_app.router.add_route('GET', '/proxy', self.handle_proxy)
+        aio_app.router.add_route('OPTIONS', '/proxy', self.handle_options)
+        runner = web.AppRunner(aio_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, self.port, backlog=1024, reuse_port=self.reuse_port or None).start()
+
+    async def handle_options(self, req):
+        return web.Response(status=200, headers=CORS_HEADERS)
+
+    def _json(self, data, status):
+        return web.json_response(data, status=status, headers=CORS_HEADERS)
+
+    async def _fetch(self, target, headers, start=None, end=None):
+        if start is not None or end is not None:
+            range_value = f"bytes={start}-{end}" if start is not None else f"bytes=-{end}"
+            headers = dict(headers, Range=range_value)
+        return await self._session.get(target, headers=headers, allow_redirects=True)
+
+    async def _first_window(self, target, headers, client_range):
+        """Equivalente assíncrono de first_window"""
+        start, end = client_range if client_range else (0, None)
+        if start is None:
+            if end <= PROXY_RANGE_CHUNK:
+                return await self._fetch(target, headers, None, end), client_range
+            probe = await self._fetch(target, headers, 0, 0)
+            total = parse_content_range(probe.headers.get('Content-Range'))[2]
+            if probe.status != 206 or total is None:
+                return probe, client_range
+            probe.release()
+            start, end = max(total - end, 0), total - 1
+            client_range = (start, end)
+        window_end = start + PROXY_RANGE_CHUNK - 1
+        if end is not None:
+            window_end = min(window_end, end)
+        return await self._fetch(target, headers, start, window_end), client_range
+
+    async def handle_proxy(self, req):
+        meter = req['meter'] = StreamMeter('async')
+        try:
+            return await self._handle_proxy(req)
+        finally:
+            meter.close()
+
+    async def _handle_proxy(self, req):
+        target = req.query.get('url', '')
+        if not target:
+            return self._json({'error': 'url param required'}, 400)
+        if not target.startswith('http://') and not target.startswith('https://'):
+            return self._json({'error': 'invalid url'}, 400)
+
+        headers = proxy_request_headers(req.headers)
+        range_header = req.headers.get('Range')
+        client_range = parse_range_header(range_header)
+
+        if manifest_cache.contains(target):
+            body = manifest_cache.get(target)
+            if body is not None:
+                return web.Response(text=body, content_type='application/vnd.apple.mpegurl', headers=CORS_HEADERS)
+
+        cache_key, cache_size = proxy_cache_identity(target, req.query.get('vid'))
+        segment_readahead.after_serve(target)
+        if cache_key and cache_size and proxy_cache.enabled and (client_range or not range_header) and not req.headers.get('If-Range'):
+            wanted = absolute_range(client_range, cache_size)
+            entry = proxy_cache.lookup(cache_key, *wanted) if wanted else None
+            if entry:
+                return await self._serve_cached(req, entry, wanted[0], wanted[1], range_header)
+
+        try:
+            if is_manifest(target):
+                r = await self._fetch(target, headers)
+            elif range_header and client_range is None:
+                r = await self._fetch(target, dict(headers, Range=range_header))
+            else:
+                r, client_range = await self._first_window(target, headers, client_range)
+                if r.status == 206 and is_manifest(target, r.headers.get('Content-Type', '')):
+                    r.release()
+                    r = await self._fetch(target, headers)
+        except Exception as e:
+            logger.error(f"Proxy fetch error for {target}: {e}")
+            return self._json({'error': 'failed to fetch target'}, 502)
+
+        content_type = r.headers.get('Content-Type', '')
+        if is_manifest(target, content_type):
+            return await self._stream_manifest(req, r, target)
+
+        if cache_key and not cache_size:
+            cache_size = response_size(r.status, r.headers)
+        status, extra_headers, next_pos, end, write_pos = plan_proxy_response(
+            r.status, r.headers, client_range, range_header, cache_key, cache_size)
+        fill = self._disk.open_fill(cache_key if write_pos is not None else None, cache_size, content_type)
+
+        resp = web.StreamResponse(status=status, headers=dict(CORS_HEADERS, **extra_headers))
+        if content_type:
+            resp.headers['Content-Type'] = content_type
+        queue = asyncio.Queue(maxsize=max(1, self.buffer_bytes // self.chunk_size))
+        pump = asyncio.ensure_future(self._pump(target, headers, r, next_pos, end, write_pos, fill, queue))
+        self.active_streams += 1
+        self.total_streams += 1
+        try:
+            await resp.prepare(req)
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                # write() espera o drain do transporte: cliente lento segura a fila
+                await resp.write(chunk)
+                self.bytes_sent += len(chunk)
+                req['meter'].add(len(chunk))
+            await resp.write_eof()
+        except ConnectionResetError:
+            logger.info(f"Cliente desconectou do stream {target}")
+        finally:
+            self.active_streams -= 1
+            pump.cancel()
+            fill.close()
+        return resp
+
+    async def _stream_manifest(self, req, r, target):
+        """Reescreve o manifesto linha a linha enquanto lê do upstream"""
+        try:
+            if r.status != 200:
+                return self._json({'error': 'failed to fetch manifest'}, 502)
+            rewrite = ManifestRewrite(target)
+            resp = web.StreamResponse(headers=dict(CORS_HEADERS, **{'Content-Type': 'application/vnd.apple.mpegurl'}))
+            await resp.prepare(req)
+            first = True
+            async for raw in r.content:
+                line = rewrite.feed(raw.decode(r.charset or 'utf-8', errors='replace'))
+                data = (line if first else '\n' + line).encode()
+                await resp.write(data)
+                req['meter'].add(len(data))
+                first = False
+            rewrite.finish()
+            await resp.write_eof()
+            return resp
+        finally:
+            r.release()
+
+    async def _pump(self, target, headers, first, next_pos, end, write_pos, fill, queue):
+        """Lê o upstream para a fila limitada; bloqueia quando o buffer do cliente enche"""
+        offset = write_pos
+        try:
+            try:
+                async for chunk in first.content.iter_chunked(self.chunk_size):
+                    if offset is not None:
+                        fill.write(offset, chunk)
+                        offset += len(chunk)
+                    await queue.put(chunk)
+            finally:
+                first.release()
+
+            for pos, window_end in range_windows(next_pos, end):
+                sub = await self._fetch(target, headers, pos, window_end)
+                try:
+                    if sub.status != 206 or parse_content_range(sub.headers.get('Content-Range'))[0] != pos:
+                        logger.error(f"Proxy range fetch {pos}-{window_end} for {target} returned {sub.status}")
+                        break
+                    offset = pos if offset is not None else None
+                    async for chunk in sub.content.iter_chunked(self.chunk_size):
+                        if offset is not None:
+                            fill.write(offset, chunk)
+                            offset += len(chunk)
+                        await queue.put(chunk)
+                finally:
+                    sub.release()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Async proxy upstream error for {target}: {e}")
+        await queue.put(None)
+
+    async def _serve_cached(self, req, entry, start, end, range_header):
+        content_type = entry['contentType'] or 'application/octet-stream'
+        if entry['ranges'] == [[0, entry['size']]]:
+            # FileResponse trata Range e usa loop.sendfile (zero-copy)
+            req['meter'].add(end - start + 1)
+            return web.FileResponse(entry['path'], headers=dict(CORS_HEADERS, **{'Content-Type': content_type}))
+        headers = dict(CORS_HEADERS, **{
+            'Content-Type': content_type,
+            'Content-Length': str(end - start + 1),
+            'Accept-Ranges': 'bytes',
+        })
+        if range_header:
+            headers['Content-Range'] = f"bytes {start}-{end}/{entry['size']}"
+        resp = web.StreamResponse(status=206 if range_header else 200, headers=headers)
+        await resp.prepare(req)
+        loop = asyncio.get_running_loop()
+        for pos in range(start, end + 1, self.chunk_size):
+            data = await loop.run_in_executor(None, read_cached, entry['path'], pos,
+                                              min(self.chunk_size, end + 1 - pos))
+            await resp.write(data)
+            req['meter'].add(len(data))
+        await resp.write_eof()
+        return resp
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'port': self.port,
+            'activeStreams': self.active_streams,
+            'totalStreams': self.total_streams,
+            'bytesSent': self.bytes_sent,
+            'bufferBytes': self.buffer_bytes,
+            'diskPendingBytes': self._disk.pending,
+            'diskDroppedBytes': self._disk.dropped,
+        }
+
+
+# Motor assíncrono do /proxy (ativado com ASYNC_PROXY_PORT)
+async_proxy = AsyncProxyEngine()
+
+def run_forked(role, fn, *args):
+    """Executa fn num processo filho recém-criado; o filho nunca volta ao supervisor"""
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # Ctrl+C chega a todo o grupo; quem coordena a parada é o supervisor
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        fn(*args)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        logger.exception(f"Falha no processo {role}")
+    finally:
+        atexit._run_exitfuncs()
+        os._exit(code)
+
+
+def run_worker(listen_socket, index, count):
+    """Worker pré-forkado: servidor threaded no socket herdado do supervisor"""
+    from werkzeug.serving import make_server
+
+    global log_listener, PROCESS_STARTED
+    log_listener = configure_logging()
+    PROCESS_STARTED = time.monotonic()
+    proxy_cache.partition(index, count)
+    transcode_cache.partition(index, count)
+    server = make_server(HOST, PORT, app, threaded=True, fd=listen_socket.fileno())
+    warmup.start()
+    async_proxy.reuse_port = True
+    async_proxy.start(HOST)
+    invidious.start_probes()
+    logger.info(f"Worker {index} (pid {os.getpid()}) atendendo em http://{HOST}:{PORT}")
+    server.serve_forever()
+
+
+def run_prefork(workers=WORKERS, host=HOST, port=PORT):
+    """Supervisor do modo produção.
+
+    Abre o socket de escuta, sobe o processo do cache compartilhado e mantém
+    `workers` processos atendendo no mesmo socket, recriando os que saírem.
+    SIGTERM/SIGINT repassam SIGTERM aos filhos e esperam todos terminarem.
+    O supervisor não cria threads, para que os forks sejam seguros.
+
+    Só os caches de streams e buscas são compartilhados; token buckets,
+    admissão e vagas de transcodificação continuam por worker, e os caches em
+    disco são particionados (ver partition).
+    """
+    global log_listener
+    if log_listener is not None:
+        atexit.unregister(log_listener.stop)
+        log_listener.stop()
+    log_listener = configure_logging(use_queue=False)
+
+    listen_socket = socket.create_server((host, port), backlog=1024)
+    listen_socket.set_inheritable(True)
+    runtime_dir = tempfile.mkdtemp(prefix='yt-proxy-')
+    shared_cache.path = os.path.join(runtime_dir, 'shared-cache.sock')
+    shared_cache.authkey = os.urandom(32)
+    cache_server = SharedCacheServer(shared_cache.path, shared_cache.authkey)
+
+    children = {}
+    stopping = False
+
+    def spawn(role, index):
+        if role == 'cache':
+            pid = run_forked(role, cache_server.serve_forever)
+        else:
+            pid = run_forked(role, run_worker, listen_socket, index, workers)
+        children[pid] = (role, index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    spawn('cache', 0)
+    deadline = time.monotonic() + 5
+    while not os.path.exists(shared_cache.path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for index in range(workers):
+        spawn('worker', index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Supervisor (pid {os.getpid()}) com {workers} workers em http://{host}:{port}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        role, index, started = children.pop(pid)
+        if stopping:
+            continue
+        logger.warning(f"Processo {role} {index} (pid {pid}) saiu com código "
+                       f"{os.waitstatus_to_exitcode(status)}; reiniciando")
+        # Evita um laço de reinício apertado quando o processo morre ao subir
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn(role, index)
+
+    shutil.rmtree(runtime_dir, ignore_errors=True)
+    logger.info("Supervisor encerrado")
+
+
 if __name__ == '__main__':
     print("🚀 Servidor YT Proxy Python FAST iniciando...")
     print("⚡ Otimizado para velocidade máxima")
     print("📡 Endpoints disponíveis:")
     print("   GET /search?q=query")
     print("   GET /stream/video_id") 
+    print("   POST /stream/batch")
+    print("   GET /playlist/playlist_id?offset=0&limit=50")
     print("   GET /play?q=query (BUSCA E TOCA DIRETO)")
+    print("   GET /transcode/video_id?fmt=mp3&br=96")
     print("   GET /health")
+    print("   GET /ready")
+    print("   GET /stats")
+    print("   GET /metrics")
+    print("   GET /invidious/stats")
     print("   GET /player (PLAYER WEB)")
-    print("🔧 Servidor rodando em http://0.0.0.0:3000")
-    
-    app.run(host='0.0.0.0', port=3000, debug=False, threaded=True)
\ No newline at end of file
+    print(f"🔧 Servidor rodando em http://{HOST}:{PORT}" + (f" com {WORKERS} workers" if WORKERS > 1 else ""))
+
+    if WORKERS > 1:
+        run_prefork()
+    else:
+        warmup.start()
+        async_proxy.start(HOST)
+        invidious.start_probes()
+
+        app.run(host=HOST, port=PORT, debug=False, threaded=True)
\ No newline at end of file
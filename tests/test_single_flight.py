@@ -0,0 +1,91 @@
+"""Extrações concorrentes para o mesmo vídeo ou busca rodam uma única vez."""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+# Configuração antes de importar o servidor: extração nas threads (o stub não
+# chega aos processos), sem rate limit, sem Invidious e armazém descartável
+os.environ['EXTRACT_PROCESSES'] = '0'
+os.environ['RATE_LIMIT_RPS'] = '0'
+os.environ['INVIDIOUS_INSTANCES'] = ''
+os.environ['METADATA_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='yt-proxy-test-'), 'meta.sqlite3')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp  # noqa: E402
+
+import server  # noqa: E402
+
+PARALLEL = 8
+# Tempo do stub: longo o bastante para todas as requisições chegarem durante a extração
+EXTRACT_DELAY = 0.5
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    """Stub do YoutubeDL.extract_info que conta as chamadas e pode falhar"""
+    state = {'calls': 0, 'fail': False}
+    lock = threading.Lock()
+
+    def extract_info(self, url, download=False, **kwargs):
+        with lock:
+            state['calls'] += 1
+        time.sleep(EXTRACT_DELAY)
+        if state['fail']:
+            raise yt_dlp.utils.DownloadError('Video unavailable')
+        if url.startswith('ytsearch'):
+            return {'entries': [{'id': 'abcdefghijk', 'title': 'resultado', 'duration': 60, 'url': 'abcdefghijk'}]}
+        expire = int(time.time()) + 6 * 3600
+        return {'id': 'abcdefghijk', 'title': 'vídeo', 'duration': 60, 'thumbnail': '', 'uploader': 'canal',
+                'url': f"https://example.googlevideo.com/videoplayback?expire={expire}&itag=251"}
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', extract_info)
+    # Só a estratégia direta: o fallback também extrai e contaria em dobro no caminho de erro
+    monkeypatch.setattr(server.audio_resolver, 'strategies', [server.get_audio_direct])
+    return state
+
+
+def fire(path):
+    """Dispara PARALLEL requisições simultâneas e devolve os códigos de status"""
+    client = server.app.test_client()
+    barrier = threading.Barrier(PARALLEL)
+    statuses = []
+
+    def run():
+        barrier.wait()
+        statuses.append(client.get(path).status_code)
+
+    threads = [threading.Thread(target=run) for _ in range(PARALLEL)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def test_stream_extracts_once(extractor):
+    statuses = fire('/stream/sflight0001')
+    assert statuses == [200] * PARALLEL
+    assert extractor['calls'] == 1
+
+
+def test_stream_error_extracts_once(extractor):
+    extractor['fail'] = True
+    statuses = fire('/stream/sflight0002')
+    assert statuses == [404] * PARALLEL
+    assert extractor['calls'] == 1
+
+
+def test_search_extracts_once(extractor):
+    statuses = fire('/search?q=single+flight+ok')
+    assert statuses == [200] * PARALLEL
+    assert extractor['calls'] == 1
+
+
+def test_search_error_extracts_once(extractor):
+    extractor['fail'] = True
+    fire('/search?q=single+flight+erro')
+    assert extractor['calls'] == 1